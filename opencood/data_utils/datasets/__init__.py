@@ -2,6 +2,8 @@
 # Author: Runsheng Xu <rxx3386@ucla.edu>
 # License: TDG-Attribution-NonCommercial-NoDistrib
 
+import torch
+
 from opencood.data_utils.datasets.late_fusion_dataset import LateFusionDataset
 from opencood.data_utils.datasets.early_fusion_dataset import EarlyFusionDataset
 from opencood.data_utils.datasets.early_fusion_dataset_v2x import EarlyFusionDatasetV2X
@@ -91,3 +93,13 @@ def build_dataset(dataset_cfg, visualize=False, train=True):
     )
 
     return dataset
+
+
+def worker_init_fn(worker_id):
+    """
+    Dataloader worker_init_fn. Calls the dataset's worker_init hook, if it
+    has one, once in every worker process.
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if hasattr(dataset, 'worker_init'):
+        dataset.worker_init()
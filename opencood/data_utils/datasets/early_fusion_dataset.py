@@ -155,7 +155,9 @@ class EarlyFusionDataset(basedataset.BaseDataset):
         Parameters
         ----------
         selected_cav_base : dict
-            The dictionary contains a single CAV's raw information.
+            The dictionary contains a single CAV's raw information. An
+            optional 'transformation_matrix' (4, 4) to the ego lidar is used
+            instead of computing it from the lidar poses.
         ego_pose : list
             The ego vehicle lidar pose under world coordinate.
 
@@ -167,9 +169,12 @@ class EarlyFusionDataset(basedataset.BaseDataset):
         selected_cav_processed = {}
 
         # calculate the transformation matrix
-        transformation_matrix = \
-            x1_to_x2(selected_cav_base['params']['lidar_pose'],
-                     ego_pose)
+        if 'transformation_matrix' in selected_cav_base:
+            transformation_matrix = selected_cav_base['transformation_matrix']
+        else:
+            transformation_matrix = \
+                x1_to_x2(selected_cav_base['params']['lidar_pose'],
+                         ego_pose)
 
         # retrieve objects under ego coordinates
         object_bbx_center, object_bbx_mask, object_ids = \
@@ -181,10 +186,11 @@ class EarlyFusionDataset(basedataset.BaseDataset):
         lidar_np = shuffle_points(lidar_np)
         # remove points that hit itself
         lidar_np = mask_ego_points(lidar_np)
-        # project the lidar to ego space
+        # project the lidar to ego space, xyz @ R.T + t in numpy without
+        # the torch round trip and the homogeneous padding
         lidar_np[:, :3] = \
-            box_utils.project_points_by_matrix_torch(lidar_np[:, :3],
-                                                     transformation_matrix)
+            box_utils.project_points_by_matrix(lidar_np[:, :3],
+                                               transformation_matrix)
 
         selected_cav_processed.update(
             {'object_bbx_center': object_bbx_center[object_bbx_mask == 1],
@@ -7,14 +7,22 @@ Dataset class for DAIR-V2X dataset early fusion
 import os
 import random
 import math
-from collections import OrderedDict
+import functools
 from opencood.data_utils.augmentor.data_augmentor import DataAugmentor
 import numpy as np
 import torch
 import json
+import pickle
+import warnings
+try:
+    # orjson parses the large label/info files several times faster
+    import orjson
+except ImportError:
+    orjson = None
 import opencood.data_utils.datasets
 import opencood.utils.pcd_utils as pcd_utils
 from opencood.utils import box_utils
+from opencood.utils.io_utils import LazyThreadPool, atomic_open
 from opencood.data_utils.post_processor import build_postprocessor
 from opencood.data_utils.datasets import early_fusion_dataset
 from opencood.data_utils.pre_processor import build_preprocessor
@@ -28,10 +36,48 @@ from opencood.utils.transformation_utils import veh_side_rot_and_trans_to_trasnf
 from opencood.utils.transformation_utils import inf_side_rot_and_trans_to_trasnformation_matrix
 
 def load_json(path):
-    with open(path, mode="r") as f:
-        data = json.load(f)
+    """
+    Load a json file.
+    """
+    if orjson is not None:
+        with open(path, mode="rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(path, mode="r") as f:
+            data = json.load(f)
     return data
 
+@functools.lru_cache(maxsize=4096)
+def load_calib_json(path):
+    """
+    Load a small calibration json. Parsed results are memoized per path in
+    a bounded cache, so callers must treat the returned object as
+    read-only. The large label files go through load_json uncached, every
+    dataloader worker would keep its own copy of them.
+    """
+    return load_json(path)
+
+def load_split(split_dir):
+    """
+    Load the list of frame ids in a split json. A pickled copy is written
+    next to it on first use and preferred afterwards, as unpickling a list
+    of strings is faster than json parsing at worker startup.
+    """
+    pkl_file = split_dir + '.pkl'
+    if os.path.exists(pkl_file) and \
+            os.path.getmtime(pkl_file) >= os.path.getmtime(split_dir):
+        with open(pkl_file, 'rb') as f:
+            return pickle.load(f)
+
+    split_info = list(load_json(split_dir))
+    # other ranks or workers may load the pickle concurrently
+    try:
+        with atomic_open(pkl_file) as f:
+            pickle.dump(split_info, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        warnings.warn("Can not write split cache to %s" % pkl_file)
+    return split_info
+
 class EarlyFusionDatasetDAIR(early_fusion_dataset.EarlyFusionDataset):
     def __init__(self, params, visualize, train=True):
         self.params = params
@@ -44,10 +90,7 @@ class EarlyFusionDatasetDAIR(early_fusion_dataset.EarlyFusionDataset):
         # the ego's coordinate frame. otherwise, the feature will be
         # projected instead.
         assert 'proj_first' in params['fusion']['args']
-        if params['fusion']['args']['proj_first']:
-            self.proj_first = True
-        else:
-            self.proj_first = False
+        self.proj_first = bool(params['fusion']['args']['proj_first'])
 
         if "kd_flag" in params.keys():
             self.kd_flag = params['kd_flag']
@@ -55,16 +98,19 @@ class EarlyFusionDatasetDAIR(early_fusion_dataset.EarlyFusionDataset):
             self.kd_flag = False
 
         assert 'clip_pc' in params['fusion']['args']
-        if params['fusion']['args']['clip_pc']:
-            self.clip_pc = True
-        else:
-            self.clip_pc = False
+        self.clip_pc = bool(params['fusion']['args']['clip_pc'])
         
         if 'select_kp' in params:
             self.select_keypoint = params['select_kp']
         else:
             self.select_keypoint = None
 
+        # optional voxel grid downsampling right after loading the lidar
+        if 'downsample_voxel' in params['preprocess']:
+            self.downsample_voxel = params['preprocess']['downsample_voxel']
+        else:
+            self.downsample_voxel = None
+
         self.pre_processor = build_preprocessor(params['preprocess'],
                                                 train)
         self.post_processor = build_postprocessor(
@@ -77,12 +123,292 @@ class EarlyFusionDatasetDAIR(early_fusion_dataset.EarlyFusionDataset):
             split_dir = params['validate_dir']
 
         self.root_dir = params['data_dir']
-        self.split_info = load_json(split_dir)
+        # directory prefixes for the per-sample paths, which are known to be
+        # relative, so plain string concatenation replaces os.path.join
+        self.root_prefix = os.path.join(self.root_dir, '')
+        self.veh_calib_dir = self.root_prefix + 'vehicle-side/calib/'
+        self.inf_calib_dir = self.root_prefix + 'infrastructure-side/calib/'
+        self.split_info = load_split(split_dir)
         co_datainfo = load_json(os.path.join(self.root_dir, 'cooperative/data_info.json'))
-        self.co_data = OrderedDict()
+        self.co_data = {}
         for frame_info in co_datainfo:
-            veh_frame_id = frame_info['vehicle_image_path'].split("/")[-1].replace(".jpg", "")
-            self.co_data[veh_frame_id] = frame_info
+            # parse the frame ids once, the loaded json itself is kept read-only
+            veh_frame_id = os.path.basename(frame_info['vehicle_image_path'])[:-len(".jpg")]
+            inf_frame_id = os.path.basename(frame_info['infrastructure_image_path'])[:-len(".jpg")]
+            self.co_data[veh_frame_id] = dict(frame_info,
+                                              veh_frame_id=veh_frame_id,
+                                              inf_frame_id=inf_frame_id)
+
+        # lidar poses only depend on the calibration files, so they are
+        # computed once and cached on disk, next to the split file unless
+        # pose_cache_dir is given.
+        pose_cache_file = os.path.splitext(split_dir)[0] + '_lidar_pose.npz'
+        if 'pose_cache_dir' in params and params['pose_cache_dir']:
+            pose_cache_file = os.path.join(params['pose_cache_dir'],
+                                           os.path.basename(pose_cache_file))
+        # stat every calibration file of the split to validate the cache,
+        # instead of only data_info.json, the split file and the calib dirs
+        self.pose_cache_full_check = 'pose_cache_full_check' in params and \
+            bool(params['pose_cache_full_check'])
+        self.load_pose_cache(pose_cache_file, split_dir)
+        # retrieve_base_data makes the veh-side the ego, so the inf-side
+        # lidar to ego transformation of each frame is fixed, T_veh_inf,
+        # (N, 4, 4)
+        self.inf_to_veh_tfms = np.array([x1_to_x2(inf_lidar_pose, veh_lidar_pose)
+                                         for veh_lidar_pose, inf_lidar_pose in self.lidar_poses])
+
+        # optionally concatenate all point clouds into a single float32 blob
+        # once and memory map it afterwards, instead of opening and parsing
+        # a pcd file per sample every epoch.
+        self.pcd_blob = None
+        if 'pcd_cache_dir' in params and params['pcd_cache_dir']:
+            self.pcd_cache_dir = params['pcd_cache_dir']
+            self.pcd_cache_prefix = os.path.join(self.pcd_cache_dir, '')
+            self.prepare_pcd_cache()
+        else:
+            self.pcd_cache_dir = None
+
+        # the per-sample json/pcd reads are independent, so they are issued
+        # concurrently
+        self.io_pool = LazyThreadPool(max_workers=6)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pcd_blob'] = None
+        return state
+
+    def worker_init(self):
+        """
+        Set up the per-process state of a dataloader worker before its first
+        sample. The frame index and the pose table are built in __init__ and
+        shared with the workers, only the io thread pool is per process.
+        """
+        self.io_pool.get()
+
+    def compute_lidar_poses(self, veh_frame_id):
+        """
+        Compute the vehicle-side and infrastructure-side lidar poses of a
+        frame from its calibration files.
+
+        Parameters
+        ----------
+        veh_frame_id : str
+            Vehicle-side frame id.
+
+        Returns
+        -------
+        lidar_poses : np.ndarray
+            Shape (2, 6), [veh_pose, inf_pose], each is
+            [x, y, z, roll, yaw, pitch].
+        """
+        frame_info = self.co_data[veh_frame_id]
+        system_error_offset = frame_info["system_error_offset"]
+        inf_frame_id = frame_info['inf_frame_id']
+
+        lidar_to_novatel_json_file = load_calib_json(f"{self.veh_calib_dir}lidar_to_novatel/{veh_frame_id}.json")
+        novatel_to_world_json_file = load_calib_json(f"{self.veh_calib_dir}novatel_to_world/{veh_frame_id}.json")
+        transformation_matrix = veh_side_rot_and_trans_to_trasnformation_matrix(lidar_to_novatel_json_file,novatel_to_world_json_file)
+
+        virtuallidar_to_world_json_file = load_calib_json(f"{self.inf_calib_dir}virtuallidar_to_world/{inf_frame_id}.json")
+        transformation_matrix1 = inf_side_rot_and_trans_to_trasnformation_matrix(virtuallidar_to_world_json_file,system_error_offset)
+
+        return np.array([tfm_to_pose(transformation_matrix),
+                         tfm_to_pose(transformation_matrix1)])
+
+    def calib_mtime(self, frame_ids):
+        """
+        Return the latest modification time of the files the lidar poses of
+        the given frames are computed from.
+        """
+        calib_files = [os.path.join(self.root_dir, 'cooperative/data_info.json')]
+        for veh_frame_id in frame_ids:
+            inf_frame_id = self.co_data[veh_frame_id]['inf_frame_id']
+            calib_files += [f"{self.veh_calib_dir}lidar_to_novatel/{veh_frame_id}.json",
+                            f"{self.veh_calib_dir}novatel_to_world/{veh_frame_id}.json",
+                            f"{self.inf_calib_dir}virtuallidar_to_world/{inf_frame_id}.json"]
+        return max(os.path.getmtime(calib_file) for calib_file in calib_files)
+
+    def pose_cache_key(self, split_dir):
+        """
+        Return a cheap fingerprint of the inputs of the lidar poses: the
+        mtime and size of data_info.json and of the split file, and the
+        mtimes of the three calib directories, which change when a calib
+        file is added, removed or atomically replaced. Edits of a calib file
+        in place are only caught by pose_cache_full_check.
+        """
+        key = []
+        for input_file in [os.path.join(self.root_dir, 'cooperative/data_info.json'),
+                           split_dir]:
+            input_stat = os.stat(input_file)
+            key += [input_stat.st_mtime, input_stat.st_size]
+        for calib_dir in [self.veh_calib_dir + 'lidar_to_novatel',
+                          self.veh_calib_dir + 'novatel_to_world',
+                          self.inf_calib_dir + 'virtuallidar_to_world']:
+            key.append(os.stat(calib_dir).st_mtime)
+        return np.array(key, dtype=np.float64)
+
+    def load_pose_cache(self, cache_path, split_dir):
+        """
+        Load the lidar poses of all frames in the split from cache_path.
+        If the cache is missing, was built from another data_dir or from
+        other inputs (see pose_cache_key), or does not cover the split, the
+        poses are computed from the calibration files and the cache is
+        rewritten. With pose_cache_full_check the cache is also rebuilt
+        when it is older than any calibration file of the split.
+
+        Parameters
+        ----------
+        cache_path : str
+            The npz file storing 'frame_ids' (N,), 'lidar_poses' (N, 2, 6),
+            the absolute 'data_dir', the 'input_key' and the 'calib_mtime'
+            of its inputs.
+        split_dir : str
+            The split file.
+        """
+        data_dir = os.path.abspath(self.root_dir)
+        input_key = self.pose_cache_key(split_dir)
+        if os.path.exists(cache_path):
+            pose_cache = np.load(cache_path)
+            frame_ids = pose_cache['frame_ids'].tolist()
+            if 'input_key' in pose_cache and \
+                    str(pose_cache['data_dir']) == data_dir and \
+                    np.array_equal(pose_cache['input_key'], input_key) and \
+                    set(self.split_info).issubset(frame_ids) and \
+                    (not self.pose_cache_full_check or
+                     float(pose_cache['calib_mtime']) >=
+                     self.calib_mtime(self.split_info)):
+                self.lidar_poses = pose_cache['lidar_poses']
+                self.fid_to_row = {fid: i for i, fid in enumerate(frame_ids)}
+                return
+
+        frame_ids = list(self.split_info)
+        self.lidar_poses = np.zeros((len(frame_ids), 2, 6))
+        for i, veh_frame_id in enumerate(frame_ids):
+            self.lidar_poses[i] = self.compute_lidar_poses(veh_frame_id)
+        self.fid_to_row = {fid: i for i, fid in enumerate(frame_ids)}
+        # the calib files were just parsed, so stating them is cheap here
+        calib_mtime = self.calib_mtime(frame_ids)
+
+        # other processes may read the cache concurrently
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            with atomic_open(cache_path) as f:
+                np.savez(f, frame_ids=np.array(frame_ids),
+                         lidar_poses=self.lidar_poses,
+                         data_dir=np.array(data_dir),
+                         input_key=input_key,
+                         calib_mtime=np.array(calib_mtime))
+        except OSError:
+            warnings.warn("Can not write lidar pose cache to %s" % cache_path)
+
+    def prepare_pcd_cache(self):
+        """
+        Append every point cloud used by the split that is not cached yet to
+        points.bin, as float32 (x, y, z, intensity) rows, and record its
+        (offset, length) in rows in index.npz.
+
+        The whole update runs under an exclusive lock on points.lock, so
+        several processes (ddp ranks, a train and a val run) sharing the
+        cache dir extend it one after the other. index.npz is replaced
+        atomically, so it always matches the rows in points.bin.
+        """
+        blob_file = self.pcd_cache_prefix + 'points.bin'
+        index_file = self.pcd_cache_prefix + 'index.npz'
+
+        # imported here, fcntl is posix only and only needed by the cache
+        import fcntl
+
+        os.makedirs(self.pcd_cache_dir, exist_ok=True)
+        with open(self.pcd_cache_prefix + 'points.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                paths, offsets, lengths = self.update_pcd_cache(blob_file,
+                                                                index_file)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self.pcd_index = {pointcloud_path: (offset, length) for
+                          pointcloud_path, offset, length in
+                          zip(paths, offsets, lengths)}
+
+    def update_pcd_cache(self, blob_file, index_file):
+        """
+        Append the missing point clouds of the split to blob_file and
+        rewrite index_file, the caller holds the cache lock.
+
+        Returns
+        -------
+        paths, offsets, lengths : list
+            The full index after the update.
+        """
+        paths, offsets, lengths = [], [], []
+        if os.path.exists(index_file) and os.path.exists(blob_file):
+            pcd_index = np.load(index_file)
+            paths = pcd_index['paths'].tolist()
+            offsets = pcd_index['offsets'].tolist()
+            lengths = pcd_index['lengths'].tolist()
+        total = offsets[-1] + lengths[-1] if paths else 0
+
+        cached = set(paths)
+        missing = []
+        for veh_frame_id in self.split_info:
+            frame_info = self.co_data[veh_frame_id]
+            for key in ["vehicle_pointcloud_path", "infrastructure_pointcloud_path"]:
+                if frame_info[key] not in cached:
+                    cached.add(frame_info[key])
+                    missing.append(frame_info[key])
+
+        if not missing:
+            return paths, offsets, lengths
+
+        with open(blob_file, 'ab') as f:
+            # drop rows of an interrupted previous run that are not indexed
+            f.truncate(total * 4 * 4)
+            for pointcloud_path in missing:
+                lidar_np, _ = pcd_utils.read_pcd(self.root_prefix + pointcloud_path)
+                lidar_np = np.ascontiguousarray(lidar_np, dtype=np.float32)
+                f.write(lidar_np.tobytes())
+                paths.append(pointcloud_path)
+                offsets.append(total)
+                lengths.append(lidar_np.shape[0])
+                total += lidar_np.shape[0]
+
+        with atomic_open(index_file) as f:
+            np.savez(f, paths=np.array(paths),
+                     offsets=np.array(offsets, dtype=np.int64),
+                     lengths=np.array(lengths, dtype=np.int64))
+        return paths, offsets, lengths
+
+    def get_pcd_blob(self):
+        """
+        Return the memory mapped point blob, (N, 4), opened once per process.
+        An empty or missing points.bin, e.g. when every cached cloud is
+        empty, can not be memory mapped and gives an empty blob.
+        """
+        if self.pcd_blob is None:
+            blob_file = self.pcd_cache_prefix + 'points.bin'
+            if os.path.exists(blob_file) and os.path.getsize(blob_file) > 0:
+                self.pcd_blob = np.memmap(blob_file, dtype=np.float32,
+                                          mode='r').reshape(-1, 4)
+            else:
+                self.pcd_blob = np.zeros((0, 4), dtype=np.float32)
+        return self.pcd_blob
+
+    def load_lidar(self, pointcloud_path):
+        """
+        Load a point cloud given its path relative to root_dir. If the pcd
+        cache is enabled, a read-only slice of the point blob is returned.
+
+        Returns
+        -------
+        lidar_np : np.ndarray
+            Shape (n, 4).
+        """
+        if self.pcd_cache_dir is not None:
+            offset, length = self.pcd_index[pointcloud_path]
+            return np.asarray(self.get_pcd_blob()[offset:offset + length])
+        lidar_np, _ = pcd_utils.read_pcd(self.root_prefix + pointcloud_path)
+        return lidar_np
 
     def retrieve_base_data(self, idx):
         """
@@ -99,34 +425,47 @@ class EarlyFusionDatasetDAIR(early_fusion_dataset.EarlyFusionDataset):
         """
         veh_frame_id = self.split_info[idx]
         frame_info = self.co_data[veh_frame_id]
-        system_error_offset = frame_info["system_error_offset"]
-        data = OrderedDict()
-        data[0] = OrderedDict() # veh-side
+        pose_row = self.fid_to_row[veh_frame_id]
+        veh_lidar_pose, inf_lidar_pose = self.lidar_poses[pose_row]
+
+        # submit all file reads first, they have no dependency on each other
+        pool = self.io_pool.get()
+        vehicles_future = pool.submit(load_json, self.root_prefix + frame_info['cooperative_label_path'])
+        veh_lidar_future = pool.submit(self.load_lidar, frame_info["vehicle_pointcloud_path"])
+        inf_lidar_future = pool.submit(self.load_lidar, frame_info["infrastructure_pointcloud_path"])
+
+        data = {}
+        data[0] = {} # veh-side
         data[0]['ego'] = True
-        data[1] = OrderedDict() # inf-side
+        data[1] = {} # inf-side
         data[1]['ego'] = False
                 
-        data[0]['params'] = OrderedDict()
-        data[0]['params']['vehicles'] = load_json(os.path.join(self.root_dir,frame_info['cooperative_label_path']))
-        lidar_to_novatel_json_file = load_json(os.path.join(self.root_dir,'vehicle-side/calib/lidar_to_novatel/'+str(veh_frame_id)+'.json'))
-        novatel_to_world_json_file = load_json(os.path.join(self.root_dir,'vehicle-side/calib/novatel_to_world/'+str(veh_frame_id)+'.json'))
+        data[0]['params'] = {}
+        # the cooperative label is shared by both sides, it is only read
+        # downstream so the same parsed list is used for each cav
+        vehicles = vehicles_future.result()
+        data[0]['params']['vehicles'] = vehicles
+        data[0]['params']['lidar_pose'] = veh_lidar_pose.tolist()
 
-        transformation_matrix = veh_side_rot_and_trans_to_trasnformation_matrix(lidar_to_novatel_json_file,novatel_to_world_json_file)
-
-        data[0]['params']['lidar_pose'] = tfm_to_pose(transformation_matrix)
-
-        data[0]['lidar_np'], _ = pcd_utils.read_pcd(os.path.join(self.root_dir,frame_info["vehicle_pointcloud_path"]))
+        lidar_np = veh_lidar_future.result()
         if self.clip_pc:
-            data[0]['lidar_np'] = data[0]['lidar_np'][data[0]['lidar_np'][:,0]>0]
+            lidar_np = lidar_np[lidar_np[:, 0] > 0]
+        if self.downsample_voxel:
+            lidar_np = pcd_utils.downsample_lidar_voxel(lidar_np, self.downsample_voxel)
+        data[0]['lidar_np'] = lidar_np
 
-        data[1]['params'] = OrderedDict()
-        inf_frame_id = frame_info['infrastructure_image_path'].split("/")[-1].replace(".jpg", "")
-        data[1]['params']['vehicles'] = load_json(os.path.join(self.root_dir,frame_info['cooperative_label_path']))
-        virtuallidar_to_world_json_file = load_json(os.path.join(self.root_dir,'infrastructure-side/calib/virtuallidar_to_world/'+str(inf_frame_id)+'.json'))
-        transformation_matrix1 = inf_side_rot_and_trans_to_trasnformation_matrix(virtuallidar_to_world_json_file,system_error_offset)
-        data[1]['params']['lidar_pose'] = tfm_to_pose(transformation_matrix1)
+        data[1]['params'] = {}
+        data[1]['params']['vehicles'] = vehicles
+        data[1]['params']['lidar_pose'] = inf_lidar_pose.tolist()
+        # the veh-side is the ego, so both transformations to the ego lidar
+        # are known without going through the world frame
+        data[0]['transformation_matrix'] = np.identity(4)
+        data[1]['transformation_matrix'] = self.inf_to_veh_tfms[pose_row]
 
-        data[1]['lidar_np'], _ = pcd_utils.read_pcd(os.path.join(self.root_dir,frame_info["infrastructure_pointcloud_path"]))
+        lidar_np = inf_lidar_future.result()
+        if self.downsample_voxel:
+            lidar_np = pcd_utils.downsample_lidar_voxel(lidar_np, self.downsample_voxel)
+        data[1]['lidar_np'] = lidar_np
         return data
 
     def __len__(self):
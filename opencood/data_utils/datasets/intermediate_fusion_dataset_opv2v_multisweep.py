@@ -7,14 +7,13 @@
 Dataset class for intermediate fusion with past k frames
 """
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 import os
 import numpy as np
 import torch
-import math
 import copy
+import functools
 
-import time
 import json
 import opencood.data_utils.post_processor as post_processor
 import opencood.utils.pcd_utils as pcd_utils
@@ -23,16 +22,112 @@ from opencood.data_utils.datasets import basedataset
 from opencood.data_utils.pre_processor import build_preprocessor
 from opencood.hypes_yaml.yaml_utils import load_yaml
 from opencood.utils.pcd_utils import \
-    mask_points_by_range, mask_ego_points, shuffle_points, \
-    downsample_lidar_minimum
+    mask_ego_points, shuffle_points, \
+    mask_ego_and_range_points, downsample_lidar_minimum
 from opencood.data_utils.augmentor.data_augmentor import DataAugmentor
-from opencood.utils.transformation_utils import tfm_to_pose, x1_to_x2, x_to_world
+from opencood.utils.transformation_utils import tfm_to_pose, x_to_world
 from opencood.utils.pose_utils import add_noise_data_dict, remove_z_axis
 from opencood.utils.common_utils import read_json
 from opencood.utils import box_utils
+from opencood.utils.io_utils import LazyThreadPool, atomic_open
 # from opencood.models.sub_modules.box_align_v2 import box_alignment_relative_sample_np
 
 
+@functools.lru_cache(maxsize=4096)
+def _load_params_cached(yaml_file):
+    json_file = yaml_file.replace("yaml", "json")
+    if os.path.exists(json_file):
+        with open(json_file, "r") as f:
+            return json.load(f)
+    return load_yaml(yaml_file)
+
+
+def load_params(yaml_file):
+    """
+    Load the params of a timestamp. The json version is preferred when it
+    exists since it parses much faster than yaml.
+
+    Consecutive samples share most of their past frames, so the parsed
+    results are memoized per path (per dataloader worker process). Only the
+    top level dict and the lidar pose are copied for the caller, e.g. pose
+    noise replaces params['lidar_pose'], the nested contents such as
+    'vehicles' are shared and must be treated as read-only.
+    """
+    params = _load_params_cached(yaml_file)
+    return dict(params, lidar_pose=list(params['lidar_pose']))
+
+
+@functools.lru_cache(maxsize=8192)
+def _pose_to_world(pose):
+    tfm = x_to_world(list(pose))
+    tfm.setflags(write=False)
+    return tfm
+
+
+@functools.lru_cache(maxsize=8192)
+def _world_to_pose(pose):
+    tfm = np.linalg.inv(_pose_to_world(pose))
+    tfm.setflags(write=False)
+    return tfm
+
+
+def cached_x_to_world(pose):
+    """
+    Memoized x_to_world. The same poses come back for all samples sharing a
+    timestamp, so the matrices are cached by pose value. The returned
+    matrix is read-only.
+    """
+    return _pose_to_world(tuple(pose))
+
+
+def cached_x1_to_x2(x1, x2):
+    """
+    Memoized version of x1_to_x2, T_x2_x1, built from the cached pose
+    matrices and the cached inverse of x2.
+    """
+    return np.dot(_world_to_pose(tuple(x2)), _pose_to_world(tuple(x1)))
+
+
+def load_lidar(lidar_file, save_npy=False, npy_fp16=False):
+    """
+    Load the lidar points of a timestamp. The npy version is preferred when
+    it exists, it is memory mapped instead of parsing the pcd. The returned
+    array is read-only and may be float16, see npy_fp16.
+
+    Parameters
+    ----------
+    lidar_file : str
+        Path of the pcd file.
+
+    save_npy : bool
+        Whether to write the npy version of the pcd when it does not exist
+        yet, so that following epochs can map it directly.
+
+    npy_fp16 : bool
+        Whether the written npy version is stored in float16, which halves
+        the bytes read and filtered per frame. The points are converted back
+        to float32 after filtering, before preprocessing.
+
+    Returns
+    -------
+    lidar_np : np.ndarray
+        Lidar points, shape (n, 4), float32 or float16.
+    """
+    npy_file = lidar_file.replace("pcd", "npy")
+    if os.path.exists(npy_file):
+        return np.load(npy_file, mmap_mode='r')
+
+    lidar_np = pcd_utils.pcd_to_np(lidar_file)
+    if save_npy and os.path.isdir(os.path.dirname(npy_file)):
+        # other workers may read the same frame concurrently
+        try:
+            with atomic_open(npy_file) as f:
+                np.save(f, lidar_np.astype(np.float16) if npy_fp16 else lidar_np)
+        except OSError:
+            print("Can not write npy lidar to %s" % npy_file)
+    return lidar_np
+
+
 class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
     """
     This class is for intermediate fusion where each vehicle transmit the
@@ -67,6 +162,25 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         else:
             self.proj_first = False
 
+        # convert the pcd files to npy on first read, later epochs map them
+        if 'save_npy_lidar' in params:
+            self.save_npy_lidar = params['save_npy_lidar']
+        else:
+            self.save_npy_lidar = False
+        # store the converted npy files in float16
+        if 'npy_lidar_fp16' in params:
+            self.npy_lidar_fp16 = params['npy_lidar_fp16']
+        else:
+            self.npy_lidar_fp16 = False
+
+        # bound once, in float32 like the points so that the range masks
+        # compare in float32 without any per call conversion
+        self.cav_lidar_range = np.asarray(params['preprocess']['cav_lidar_range'],
+                                          dtype=np.float32)
+
+        # compared against squared distances, saves the sqrt per cav
+        self.comm_range_sq = float(params['comm_range']) ** 2
+
         if self.train:
             root_dir = params['root_dir']
         else:
@@ -80,25 +194,21 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         else:
             self.max_cav = params['train_params']['max_cav']
 
-        # first load all paths of different scenarios
-        scenario_folders = sorted([os.path.join(root_dir, x)
-                                   for x in os.listdir(root_dir) if
-                                   os.path.isdir(os.path.join(root_dir, x))])
-        scenario_folders_name = sorted([x
-                                   for x in os.listdir(root_dir) if
-                                   os.path.isdir(os.path.join(root_dir, x))])
+        # first load all paths of different scenarios. scandir gets the
+        # entry types along with the names, saving a stat per entry.
+        with os.scandir(root_dir) as it:
+            scenario_folders_name = sorted([x.name for x in it if x.is_dir()])
+        scenario_folders = [os.path.join(root_dir, x)
+                            for x in scenario_folders_name]
         '''
         scenario_database Structure: 
         {
             scenario_id : {
                 cav_1 : {
                     'ego' : true / false , 
-                    timestamp1 : {
-                        yaml: path,
-                        lidar: path, 
-                        cameras: list of path
-                    },
-                    ...
+                    'timestamp_keys' : [timestamp1, timestamp2, ...],
+                    'yaml_files' : [yaml path of timestamp1, ...],
+                    'lidar_files' : [lidar path of timestamp1, ...]
                 },
                 ...
             }
@@ -112,9 +222,8 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             self.scenario_database.update({i: OrderedDict()})
 
             # at least 1 cav should show up
-            cav_list = sorted([x 
-                               for x in os.listdir(scenario_folder) if 
-                               os.path.isdir(os.path.join(scenario_folder, x))])
+            with os.scandir(scenario_folder) as it:
+                cav_list = sorted([x.name for x in it if x.is_dir()])
             assert len(cav_list) > 0
 
             # roadside unit data's id is always negative, so here we want to
@@ -128,39 +237,32 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
                 if j > self.max_cav - 1:
                     print('too many cavs')
                     break
-                self.scenario_database[i][cav_id] = OrderedDict()
-
                 # save all yaml files to the dictionary
                 cav_path = os.path.join(scenario_folder, cav_id)
 
                 # use the frame number as key, the full path as the values
+                with os.scandir(cav_path) as it:
+                    cav_file_names = [x.name for x in it]
                 yaml_files = \
                     sorted([os.path.join(cav_path, x)
-                            for x in os.listdir(cav_path) if
+                            for x in cav_file_names if
                             x.endswith('.yaml')])
                 if len(yaml_files)==0:
                     yaml_files = \
                         sorted([os.path.join(cav_path, x)
-                                for x in os.listdir(cav_path) if
+                                for x in cav_file_names if
                                 x.endswith('.json')])
                 timestamps = self.extract_timestamps(yaml_files)	
 
-                for timestamp in timestamps:
-                    self.scenario_database[i][cav_id][timestamp] = \
-                        OrderedDict()
-
-                    yaml_file = os.path.join(cav_path,
-                                             timestamp + '.yaml')
-                    lidar_file = os.path.join(cav_path,
-                                              timestamp + '.pcd')
-                    # camera_files = self.load_camera_files(cav_path, timestamp)
-
-                    self.scenario_database[i][cav_id][timestamp]['yaml'] = \
-                        yaml_file
-                    self.scenario_database[i][cav_id][timestamp]['lidar'] = \
-                        lidar_file
-                    # self.scenario_database[i][cav_id][timestamp]['camera0'] = \
-                        # camera_files
+                # the paths are kept as parallel lists indexed by the
+                # timestamp index instead of one dict per timestamp
+                cav_path_prefix = os.path.join(cav_path, '')
+                self.scenario_database[i][cav_id] = {
+                    'timestamp_keys': timestamps,
+                    'yaml_files': [cav_path_prefix + timestamp + '.yaml'
+                                   for timestamp in timestamps],
+                    'lidar_files': [cav_path_prefix + timestamp + '.pcd'
+                                    for timestamp in timestamps]}
 
                 # Assume all cavs will have the same timestamps length. Thus
                 # we only need to calculate for the first vehicle in the
@@ -190,11 +292,31 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             train)
 
         self.anchor_box = self.post_processor.generate_anchor_box()
+        # for the binary search of the scenario index
+        self.len_record_np = np.asarray(self.len_record)
+
+        # identity templates of the pairwise transformation matrices, copied
+        # per sample instead of tiling np.eye every time
+        self.identity_pairwise = np.tile(np.eye(4), (self.max_cav, self.max_cav, 1, 1))
+        self.identity_pairwise.setflags(write=False)
+        self.identity_past_k = np.tile(np.eye(4), (self.max_cav, self.k, 1, 1))
+        self.identity_past_k.setflags(write=False)
+
+        # the per-sample lidar reads are independent, so they are issued
+        # concurrently
+        self.io_pool = LazyThreadPool(max_workers=8)
 
         print("OPV2V Multi-sweep dataset with non-ego cavs' {} time delay and past {} frames collected initialized! \
                 {} samples totally!".format(self.tau, self.k, self.len_record[-1]))
 
-    def retrieve_base_data(self, idx):
+    def worker_init(self):
+        """
+        Set up the per-process state of a dataloader worker before its first
+        sample, i.e. the io thread pool.
+        """
+        self.io_pool.get()
+
+    def retrieve_base_data(self, idx, skip_far_cav=False):
         """
         Given the index, return the corresponding data.
 
@@ -203,6 +325,11 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         idx : int
             Index given by dataloader.
 
+        skip_far_cav : bool
+            If true, the non-ego cavs out of the communication range (judged
+            by their latest frame, i.e. past_k[0]) are left out before any
+            of their other files are loaded.
+
         Returns
         -------
         data : dict
@@ -249,65 +376,59 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
                 ...
             }
         """
-        # we loop the accumulated length list to get the scenario index
-        scenario_index = 0
-        for i, ele in enumerate(self.len_record):
-            if idx < ele:
-                scenario_index = i
-                break
+        # search the accumulated length list to get the scenario index
+        scenario_index = int(np.searchsorted(self.len_record_np, idx, side='right'))
         scenario_database = self.scenario_database[scenario_index]
-
-        debug_times = np.zeros((3,))
-        start_time = time.time()
+        # index of the sample inside the scenario
+        idx_in_scenario = idx if scenario_index == 0 else \
+            idx - self.len_record[scenario_index - 1]
 
         data = OrderedDict()
+        # lidar reads are independent and io bound, they are submitted to
+        # the io pool and collected after all params are loaded.
+        io_pool = self.io_pool.get()
+        lidar_futures = []
+        # the ego is always the first cav
+        ego_lidar_pose = None
         # load files for all CAVs
         for cav_id, cav_content in scenario_database.items():
             '''
             cav_content 
             {
                 'ego' : true / false , 
-                timestamp1 : {
-                    yaml: path,
-                    lidar: path, 
-                    cameras: list of path
-                },
-                ...
+                'timestamp_keys' : [timestamp1, timestamp2, ...],
+                'yaml_files' : [yaml path of timestamp1, ...],
+                'lidar_files' : [lidar path of timestamp1, ...]
             },
             '''
+            if skip_far_cav and not cav_content['ego'] and \
+                    ego_lidar_pose is not None:
+                # only the pose of the latest frame is needed for the check
+                lidar_pose = load_params(
+                    cav_content['yaml_files'][idx_in_scenario + self.k - 1])['lidar_pose']
+                dx = lidar_pose[0] - ego_lidar_pose[0]
+                dy = lidar_pose[1] - ego_lidar_pose[1]
+                if dx * dx + dy * dy > self.comm_range_sq:
+                    continue
+
             data[cav_id] = OrderedDict()
             data[cav_id]['ego'] = cav_content['ego']
             data[cav_id]['past_k'] = OrderedDict()
             
             # current frame, for co-perception lable use
             data[cav_id]['curr'] = {}
-            timestamp_index = idx if scenario_index == 0 else \
-                        idx - self.len_record[scenario_index - 1]
-            timestamp_index = timestamp_index + self.tau + self.k - 1
-            timestamp_key = list(cav_content.items())[timestamp_index][0]
+            timestamp_index = idx_in_scenario + self.tau + self.k - 1
+            timestamp_key = cav_content['timestamp_keys'][timestamp_index]
             
-            time_s = time.time()
             # load param file: json is faster than yaml
-            json_file = cav_content[timestamp_key]['yaml'].replace("yaml", "json")
-            if os.path.exists(json_file):
-                with open(json_file, "r") as f:
-                    data[cav_id]['curr']['params'] = json.load(f)
-            else:
-                data[cav_id]['curr']['params'] = \
-                        load_yaml(cav_content[timestamp_key]['yaml'])
-            time_e = time.time()
-            debug_times[0] += (time_e - time_s)
-
-            time_s = time.time()
-            # load lidar file: npy is faster than pcd
-            npy_file = cav_content[timestamp_key]['lidar'].replace("pcd", "npy")
-            if os.path.exists(npy_file):
-                data[cav_id]['curr']['lidar_np'] = np.load(npy_file)
-            else:
-                data[cav_id]['curr']['lidar_np'] = \
-                        pcd_utils.pcd_to_np(cav_content[timestamp_key]['lidar'])
-            time_e = time.time()
-            debug_times[1] += (time_e - time_s)
+            data[cav_id]['curr']['params'] = \
+                    load_params(cav_content['yaml_files'][timestamp_index])
+            if cav_content['ego']:
+                ego_lidar_pose = data[cav_id]['curr']['params']['lidar_pose']
+            lidar_futures.append(
+                (data[cav_id]['curr'],
+                 io_pool.submit(load_lidar, cav_content['lidar_files'][timestamp_index],
+                                self.save_npy_lidar, self.npy_lidar_fp16)))
 
             data[cav_id]['curr']['timestamp'] = \
                     timestamp_key
@@ -321,42 +442,24 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             for i in range(self.k):
                 # check the timestamp index
                 data[cav_id]['past_k'][i] = OrderedDict()
-                timestamp_index = idx if scenario_index == 0 else \
-                    idx - self.len_record[scenario_index - 1] # TODO: 这里面原来错加了一个i，记得改正
-                timestamp_index = timestamp_index + self.k - 1 - i + temp
-                timestamp_key = list(cav_content.items())[timestamp_index][0]
+                timestamp_index = idx_in_scenario + self.k - 1 - i + temp # TODO: 这里面原来错加了一个i，记得改正
+                timestamp_key = cav_content['timestamp_keys'][timestamp_index]
                 # load the corresponding data into the dictionary
-                time_s = time.time()
                 # load param file: json is faster than yaml
-                json_file = cav_content[timestamp_key]['yaml'].replace("yaml", "json")
-                if os.path.exists(json_file):
-                    with open(json_file, "r") as f:
-                        data[cav_id]['past_k'][i]['params'] = json.load(f)
-                else:
-                    data[cav_id]['past_k'][i]['params'] = \
-                        load_yaml(cav_content[timestamp_key]['yaml'])
-                time_e = time.time()
-                debug_times[0] += (time_e - time_s)
-
-                time_s = time.time()
-                # load lidar file: npy is faster than pcd
-                npy_file = cav_content[timestamp_key]['lidar'].replace("pcd", "npy")
-                if os.path.exists(npy_file):
-                    data[cav_id]['past_k'][i]['lidar_np'] = np.load(npy_file)
-                else:
-                    data[cav_id]['past_k'][i]['lidar_np'] = \
-                            pcd_utils.pcd_to_np(cav_content[timestamp_key]['lidar'])
-                time_e = time.time()
-                debug_times[1] += (time_e - time_s)
+                data[cav_id]['past_k'][i]['params'] = \
+                    load_params(cav_content['yaml_files'][timestamp_index])
+                lidar_futures.append(
+                    (data[cav_id]['past_k'][i],
+                     io_pool.submit(load_lidar, cav_content['lidar_files'][timestamp_index],
+                                    self.save_npy_lidar, self.npy_lidar_fp16)))
 
                 data[cav_id]['past_k'][i]['timestamp'] = \
                     timestamp_key
                 data[cav_id]['past_k'][i]['time_diff'] = \
                     self.dist_time(timestamp_key, data[cav_id]['curr']['timestamp'])
 
-        end_time = time.time()
-
-        debug_times[2] += (end_time - start_time)
+        for frame_content, lidar_future in lidar_futures:
+            frame_content['lidar_np'] = lidar_future.result()
 
         return data
 
@@ -382,8 +485,8 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
                 np.array of len(\sum_i^num_cav k_i), k_i represents the num of past frames of cav_i
         }
         '''
-        # base_data_dict
-        base_data_dict = self.retrieve_base_data(idx)
+        # base_data_dict, cavs out of the communication range are not loaded
+        base_data_dict = self.retrieve_base_data(idx, skip_far_cav=True)
 
         processed_data_dict = OrderedDict()
         processed_data_dict['ego'] = {}
@@ -414,13 +517,11 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         for cav_id, selected_cav_base in base_data_dict.items():
             # check if the cav is within the communication range with ego
             # for non-ego cav, we use the latest frame's pose
-            distance = \
-                math.sqrt( \
-                    (selected_cav_base['past_k'][0]['params']['lidar_pose'][0] - ego_lidar_pose[0]) ** 2 + \
-                    (selected_cav_base['past_k'][0]['params']['lidar_pose'][1] - ego_lidar_pose[1]) ** 2)
+            dx = selected_cav_base['past_k'][0]['params']['lidar_pose'][0] - ego_lidar_pose[0]
+            dy = selected_cav_base['past_k'][0]['params']['lidar_pose'][1] - ego_lidar_pose[1]
 
             # if distance is too far, we will just skip this agent
-            if distance > self.params['comm_range']:
+            if dx * dx + dy * dy > self.comm_range_sq:
                 too_far.append(cav_id)
                 continue
 
@@ -428,7 +529,11 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             cav_id_list.append(cav_id)  
 
         single_label_dict_stack = []
-        object_stack = []
+        # every cav contributes at most max_num boxes, so the boxes are
+        # copied into one preallocated buffer instead of stacked afterwards
+        max_num = self.params['postprocess']['max_num']
+        object_stack = np.empty((max_num * len(cav_id_list), 7))
+        object_stack_len = 0
         object_id_stack = []
         curr_pose_stack = []
         curr_feature_stack = []
@@ -474,7 +579,10 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             single_label_dict_stack.append(selected_cav_processed['single_label_dict'])
 
             # curr ego view label
-            object_stack.append(selected_cav_processed['object_bbx_center'])
+            cav_object_num = selected_cav_processed['object_bbx_center'].shape[0]
+            object_stack[object_stack_len:object_stack_len + cav_object_num] = \
+                selected_cav_processed['object_bbx_center']
+            object_stack_len += cav_object_num
             object_id_stack += selected_cav_processed['object_ids']
 
             # current pose: N, 6
@@ -511,18 +619,16 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         curr_lidar_poses = np.array(curr_pose_stack).reshape(-1, 6)  # (N_cav, 6)
         past_k_lidar_poses = np.array(past_k_pose_stack).reshape(-1, self.k, 6)  # (N, k, 6)
 
-        # exclude all repetitive objects    
-        unique_indices = \
-            [object_id_stack.index(x) for x in set(object_id_stack)]
-        object_stack = np.vstack(object_stack)
-        object_stack = object_stack[unique_indices]
+        # exclude all repetitive objects, keep the first occurrence of each id
+        object_id_stack = np.asarray(object_id_stack)
+        _, unique_indices = np.unique(object_id_stack, return_index=True)
 
         # make sure bounding boxes across all frames have the same number
-        object_bbx_center = \
-            np.zeros((self.params['postprocess']['max_num'], 7))
-        mask = np.zeros(self.params['postprocess']['max_num'])
-        object_bbx_center[:object_stack.shape[0], :] = object_stack
-        mask[:object_stack.shape[0]] = 1
+        object_bbx_center = np.zeros((max_num, 7))
+        mask = np.zeros(max_num)
+        object_bbx_center[:unique_indices.shape[0], :] = \
+            object_stack[:object_stack_len][unique_indices]
+        mask[:unique_indices.shape[0]] = 1
 
         # merge preprocessed features from different cavs into the same dict
         cav_num = len(cav_id_list)
@@ -544,7 +650,7 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             'curr_processed_lidar': merged_curr_feature_dict,
             'object_bbx_center': object_bbx_center,
             'object_bbx_mask': mask,
-            'object_ids': [object_id_stack[i] for i in unique_indices],
+            'object_ids': object_id_stack[unique_indices].tolist(),
             'anchor_box': anchor_box,
             'processed_lidar': merged_feature_dict,
             'label_dict': label_dict,
@@ -614,28 +720,32 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
 
         # curr lidar feature
         lidar_np = selected_cav_base['curr']['lidar_np']
-        lidar_np = shuffle_points(lidar_np)
-        lidar_np = mask_ego_points(lidar_np) # remove points that hit itself
 
         if self.visualize:
+            # visualization keeps the points out of range
+            vis_lidar_np = mask_ego_points(lidar_np) # remove points that hit itself
             # trans matrix
             transformation_matrix = \
-                x1_to_x2(selected_cav_base['curr']['params']['lidar_pose'], ego_pose) # T_ego_cav, np.ndarray
+                cached_x1_to_x2(selected_cav_base['curr']['params']['lidar_pose'], ego_pose) # T_ego_cav, np.ndarray
             projected_lidar = \
-                box_utils.project_points_by_matrix_torch(lidar_np[:, :3], transformation_matrix)
+                box_utils.project_points_by_matrix(vis_lidar_np[:, :3], transformation_matrix)
             selected_cav_processed.update(
                 {
                     'projected_lidar': projected_lidar
                 }
             )
 
-        lidar_np = mask_points_by_range(lidar_np, self.params['preprocess']['cav_lidar_range'])
-        curr_feature = self.pre_processor.preprocess(lidar_np)
+        # remove points that hit itself and out of range in one pass, then
+        # shuffle only the remaining points
+        lidar_np = mask_ego_and_range_points(lidar_np, self.cav_lidar_range)
+        lidar_np = shuffle_points(lidar_np)
+        # float16 npy frames are only converted after the filtering
+        lidar_np = lidar_np.astype(np.float32, copy=False)
+        # curr and past k lidars, preprocessed together after the loop
+        sweep_lidar_list = [lidar_np]
         
         # past k transfomation matrix
         past_k_tr_mats = []
-        # past k lidars
-        past_k_features = []
         # past k poses
         past_k_poses = []
         # past k timestamps
@@ -648,16 +758,15 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         for i in range(self.k):
             # 1. trans matrix
             transformation_matrix = \
-                x1_to_x2(selected_cav_base['past_k'][i]['params']['lidar_pose'], ego_pose) # T_ego_cav, np.ndarray
+                cached_x1_to_x2(selected_cav_base['past_k'][i]['params']['lidar_pose'], ego_pose) # T_ego_cav, np.ndarray
             past_k_tr_mats.append(transformation_matrix)
 
             # 2. lidar feature
             lidar_np = selected_cav_base['past_k'][i]['lidar_np']
+            lidar_np = mask_ego_and_range_points(lidar_np, self.cav_lidar_range)
             lidar_np = shuffle_points(lidar_np)
-            lidar_np = mask_ego_points(lidar_np) # remove points that hit itself
-            lidar_np = mask_points_by_range(lidar_np, self.params['preprocess']['cav_lidar_range'])
-            processed_features = self.pre_processor.preprocess(lidar_np)
-            past_k_features.append(processed_features)
+            lidar_np = lidar_np.astype(np.float32, copy=False)
+            sweep_lidar_list.append(lidar_np)
 
             # 3. pose
             past_k_poses.append(selected_cav_base['past_k'][i]['params']['lidar_pose'])
@@ -694,6 +803,11 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
 
         past_k_tr_mats = np.stack(past_k_tr_mats, axis=0) # (k, 4, 4)
 
+        # curr lidar feature and past k lidar features
+        sweep_features = self.pre_processor.preprocess_batch(sweep_lidar_list)
+        curr_feature = sweep_features[0]
+        past_k_features = sweep_features[1:]
+
         # curr label at single view
         # opencood/data_utils/post_processor/base_postprocessor.py
         object_bbx_center, object_bbx_mask, object_ids = \
@@ -745,7 +859,7 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             The timestamp key saved in the cav dictionary.
         """
         # retrieve the correct index
-        timestamp_key = list(cav_content.items())[timestamp_index][0]
+        timestamp_key = cav_content['timestamp_keys'][timestamp_index]
 
         return timestamp_key
 
@@ -783,18 +897,17 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             key: feature names, value: list of features.
         """
 
-        merged_feature_dict = OrderedDict()
+        merged_feature_dict = defaultdict(list)
 
-        for cav_id in range(len(processed_feature_list)):
+        for cav_features in processed_feature_list:
             for time_id in range(self.k):
-                for feature_name, feature in processed_feature_list[cav_id][time_id].items():
-                    if feature_name not in merged_feature_dict:
-                        merged_feature_dict[feature_name] = []
+                for feature_name, feature in cav_features[time_id].items():
                     if isinstance(feature, list):
                         merged_feature_dict[feature_name] += feature
                     else:
                         merged_feature_dict[feature_name].append(feature) # merged_feature_dict['coords'] = [f1,f2,f3,f4]
-        return merged_feature_dict
+        # plain dict, missing features should not silently become []
+        return dict(merged_feature_dict)
 
     @staticmethod
     def merge_features_to_dict(processed_feature_list):
@@ -814,17 +927,16 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             key: feature names, value: list of features.
         """
 
-        merged_feature_dict = OrderedDict()
+        merged_feature_dict = defaultdict(list)
 
-        for i in range(len(processed_feature_list)):
-            for feature_name, feature in processed_feature_list[i].items():
-                if feature_name not in merged_feature_dict:
-                    merged_feature_dict[feature_name] = []
+        for processed_feature in processed_feature_list:
+            for feature_name, feature in processed_feature.items():
                 if isinstance(feature, list):
                     merged_feature_dict[feature_name] += feature
                 else:
                     merged_feature_dict[feature_name].append(feature) # merged_feature_dict['coords'] = [f1,f2,f3,f4]
-        return merged_feature_dict
+        # plain dict, missing features should not silently become []
+        return dict(merged_feature_dict)
 
     def collate_batch_train(self, batch):
         '''
@@ -859,8 +971,16 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         neg_equal_one_single = []
         targets_single = []
 
-        object_bbx_center = []
-        object_bbx_mask = []
+        # fixed size entries are written into preallocated batch buffers
+        batch_size = len(batch)
+        ego_dict = batch[0]['ego']
+        object_bbx_center = np.empty((batch_size,) + ego_dict['object_bbx_center'].shape,
+                                     dtype=ego_dict['object_bbx_center'].dtype)
+        object_bbx_mask = np.empty((batch_size,) + ego_dict['object_bbx_mask'].shape,
+                                   dtype=ego_dict['object_bbx_mask'].dtype)
+        # pairwise transformation matrix
+        pairwise_t_matrix = np.empty((batch_size,) + ego_dict['pairwise_t_matrix'].shape,
+                                     dtype=ego_dict['pairwise_t_matrix'].dtype)
         object_ids = []
         curr_processed_lidar_list = []
         processed_lidar_list = []
@@ -872,8 +992,6 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         past_k_label_list = []
         # store the time interval of each feature map
         past_k_time_interval = []
-        # pairwise transformation matrix
-        pairwise_t_matrix_list = []
 
         if self.visualize:
             origin_lidar = []
@@ -887,8 +1005,8 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             targets_single.append(ego_dict['single_object_dict_stack']['targets'])
 
             curr_processed_lidar_list.append(ego_dict['curr_processed_lidar'])
-            object_bbx_center.append(ego_dict['object_bbx_center'])
-            object_bbx_mask.append(ego_dict['object_bbx_mask'])
+            object_bbx_center[i] = ego_dict['object_bbx_center']
+            object_bbx_mask[i] = ego_dict['object_bbx_mask']
             object_ids.append(ego_dict['object_ids'])
             curr_lidar_pose_list.append(ego_dict['curr_lidar_poses']) # ego_dict['curr_lidar_pose'] is np.ndarray [N,6]
             past_k_lidar_pose_list.append(ego_dict['past_k_lidar_poses']) # ego_dict['past_k_lidar_pose'] is np.ndarray [N,k,6]
@@ -896,7 +1014,7 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             processed_lidar_list.append(ego_dict['processed_lidar']) # different cav_num, ego_dict['processed_lidar'] is list.
             record_len.append(ego_dict['cav_num'])
             label_dict_list.append(ego_dict['label_dict'])
-            pairwise_t_matrix_list.append(ego_dict['pairwise_t_matrix'])
+            pairwise_t_matrix[i] = ego_dict['pairwise_t_matrix']
             # past_k_label_list.append(ego_dict['past_k_label_dicts'])
 
             if self.visualize:
@@ -915,10 +1033,10 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         past_k_time_interval = np.hstack(past_k_time_interval)
         past_k_time_interval = torch.from_numpy(past_k_time_interval)
 
-        # convert to numpy, (B, max_num, 7)
-        object_bbx_center = torch.from_numpy(np.array(object_bbx_center))
+        # (B, max_num, 7)
+        object_bbx_center = torch.from_numpy(object_bbx_center)
         # （B, max_num)
-        object_bbx_mask = torch.from_numpy(np.array(object_bbx_mask))
+        object_bbx_mask = torch.from_numpy(object_bbx_mask)
         
         curr_merged_feature_dict = self.merge_features_to_dict(curr_processed_lidar_list)
         curr_processed_lidar_torch_dict = \
@@ -940,7 +1058,7 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             self.post_processor.collate_batch(label_dict_list)
 
         # (B, max_cav, k, 4, 4)
-        pairwise_t_matrix = torch.from_numpy(np.array(pairwise_t_matrix_list))
+        pairwise_t_matrix = torch.from_numpy(pairwise_t_matrix)
 
         # add pairwise_t_matrix to label dict
         label_torch_dict['pairwise_t_matrix'] = pairwise_t_matrix
@@ -976,7 +1094,6 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
         return output_dict
 
     def collate_batch_test(self, batch):
-        assert len(batch) <= 1, "Batch size 1 is required during testing!"
         output_dict = self.collate_batch_train(batch)
         if output_dict is None:
             return None
@@ -1005,6 +1122,11 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             "cav_id_list": batch[0]['ego']['cav_id_list']
         })
 
+        # with several scenes in a test batch, the gt generation needs the
+        # object ids of each scene, see inference_utils.split_batch_scenes
+        output_dict['ego'].update({
+            'object_ids_list': [cav['ego']['object_ids'] for cav in batch]})
+
         # output_dict['ego'].update({'veh_frame_id': batch[0]['ego']['veh_frame_id']})
 
         return output_dict
@@ -1053,7 +1175,10 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             shape: (L, L, 4, 4), L is the max cav number in a scene
             pairwise_t_matrix[i, j] is Tji, i_to_j
         """
-        pairwise_t_matrix = np.tile(np.eye(4), (max_cav, max_cav, 1, 1)) # (L, L, 4, 4)
+        if max_cav == self.max_cav:
+            pairwise_t_matrix = self.identity_pairwise.copy() # (L, L, 4, 4)
+        else:
+            pairwise_t_matrix = np.tile(np.eye(4), (max_cav, max_cav, 1, 1)) # (L, L, 4, 4)
 
         if self.proj_first:
             # if lidar projected to ego first, then the pairwise matrix
@@ -1063,21 +1188,17 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             # pairwise_t_matrix[:, :] = np.identity(4)
             return pairwise_t_matrix
         else:
-            t_list = []
-
-            # save all transformation matrix in a list in order first.
-            for cav_id, cav_content in base_data_dict.items():
-                lidar_pose = cav_content['curr']['params']['lidar_pose']
-                t_list.append(x_to_world(lidar_pose))  # Twx
-
-            for i in range(len(t_list)):
-                for j in range(len(t_list)):
-                    # identity matrix to self
-                    if i != j:
-                        # i->j: TiPi=TjPj, Tj^(-1)TiPi = Pj
-                        # t_matrix = np.dot(np.linalg.inv(t_list[j]), t_list[i])
-                        t_matrix = np.linalg.solve(t_list[j], t_list[i])  # Tjw*Twi = Tji
-                        pairwise_t_matrix[i, j] = t_matrix
+            # stack all transformation matrix in order first, (N, 4, 4), Twx
+            t_world = np.stack([cached_x_to_world(cav_content['curr']['params']['lidar_pose'])
+                                for cav_content in base_data_dict.values()])
+            cav_num = t_world.shape[0]
+
+            # i->j: TiPi=TjPj, Tj^(-1)TiPi = Pj, all pairs in one batch
+            t_world_inv = np.linalg.inv(t_world)  # Tjw
+            pairwise_t_matrix[:cav_num, :cav_num] = \
+                np.einsum('jab,ibc->ijac', t_world_inv, t_world)  # Tjw*Twi = Tji
+            # identity matrix to self
+            pairwise_t_matrix[np.arange(cav_num), np.arange(cav_num)] = np.eye(4)
 
         return pairwise_t_matrix
     
@@ -1103,7 +1224,10 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             shape: (L, k, 4, 4), L is the max cav number in a scene, k is the num of past frames
             pairwise_t_matrix[i, j] is T i_to_ego at past_j frame
         """
-        pairwise_t_matrix = np.tile(np.eye(4), (max_cav, self.k, 1, 1)) # (L, k, 4, 4)
+        if max_cav == self.max_cav:
+            pairwise_t_matrix = self.identity_past_k.copy() # (L, k, 4, 4)
+        else:
+            pairwise_t_matrix = np.tile(np.eye(4), (max_cav, self.k, 1, 1)) # (L, k, 4, 4)
 
         if self.proj_first:
             # if lidar projected to ego first, then the pairwise matrix
@@ -1119,10 +1243,10 @@ class IntermediateFusionDatasetMultisweep(basedataset.BaseDataset):
             for cav_id, cav_content in base_data_dict.items():
                 past_k_poses = []
                 for time_id in range(self.k):
-                    past_k_poses.append(x_to_world(cav_content['past_k'][time_id]['params']['lidar_pose']))
+                    past_k_poses.append(cached_x_to_world(cav_content['past_k'][time_id]['params']['lidar_pose']))
                 t_list.append(past_k_poses) # Twx
             
-            ego_pose = x_to_world(ego_pose)
+            ego_pose = cached_x_to_world(ego_pose)
             for i in range(len(t_list)): # different cav
                 if i!=0 :
                     for j in range(len(t_list[i])): # different time
@@ -338,6 +338,8 @@ class LateFusionDatasetRegular(intermediate_fusion_dataset_opv2v_multisweep.Inte
                                                 'cav_lidar_range'])
             # remove points that hit ego vehicle
             lidar_np = mask_ego_points(lidar_np)
+            # float16 npy frames are only converted after the filtering
+            lidar_np = lidar_np.astype(np.float32, copy=False)
             
             # tag illegal situation
             if lidar_np.shape[0] == 0: # 没有点留下
@@ -443,6 +445,7 @@ class LateFusionDatasetRegular(intermediate_fusion_dataset_opv2v_multisweep.Inte
         lidar_np = mask_ego_points(lidar_np) # remove points that hit itself
 
         lidar_np = mask_points_by_range(lidar_np, self.params['preprocess']['cav_lidar_range'])
+        lidar_np = lidar_np.astype(np.float32, copy=False)
         curr_feature = self.pre_processor.preprocess(lidar_np)
         
         # # past k transfomation matrix
@@ -474,6 +477,7 @@ class LateFusionDatasetRegular(intermediate_fusion_dataset_opv2v_multisweep.Inte
             lidar_np = shuffle_points(lidar_np)
             lidar_np = mask_ego_points(lidar_np) # remove points that hit itself
             lidar_np = mask_points_by_range(lidar_np, self.params['preprocess']['cav_lidar_range'])
+            lidar_np = lidar_np.astype(np.float32, copy=False)
             processed_features = self.pre_processor.preprocess(lidar_np)
             past_k_features.append(processed_features)
 
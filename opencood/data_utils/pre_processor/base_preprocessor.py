@@ -45,6 +45,24 @@ class BasePreprocessor(object):
 
         return data_dict
 
+    def preprocess_batch(self, pcd_np_list):
+        """
+        Preprocess several lidar frames, e.g. all sweeps of a cav. The
+        frames are processed one by one here, preprocessors with a batched
+        implementation can override it.
+
+        Parameters
+        ----------
+        pcd_np_list : list
+            List of raw lidar, np.ndarray.
+
+        Returns
+        -------
+        data_dict_list : list
+            The output dictionary of each frame, in order.
+        """
+        return [self.preprocess(pcd_np) for pcd_np in pcd_np_list]
+
     def project_points_to_bev_map(self, points, ratio=0.1):
         """
         Project points to BEV occupancy map with default ratio=0.1.
@@ -34,13 +34,10 @@ class BevPreprocessor(BasePreprocessor):
         """
         bev = np.zeros(self.geometry_param['input_shape'], dtype=np.float32)
         intensity_map_count = np.zeros((bev.shape[0], bev.shape[1]),
-                                       dtype=np.int)
-        bev_origin = np.array(
-            [self.geometry_param["L1"], self.geometry_param["W1"],
-             self.geometry_param["H1"]]).reshape(1, -1)
-
-        indices = ((pcd_raw[:, :3] - bev_origin) / self.geometry_param[
-            "res"]).astype(int)
+                                       dtype=int)
+        indices, in_grid = self._grid_indices(pcd_raw)
+        pcd_raw = pcd_raw[in_grid]
+        indices = indices[in_grid]
 
         # if any point hit this voxel, set the voxel to 1
         for i in range(indices.shape[0]):
@@ -56,6 +53,82 @@ class BevPreprocessor(BasePreprocessor):
         }
         return data_dict
 
+    def preprocess_batch(self, pcd_np_list):
+        """
+        Preprocess several lidar frames to BEV representations at once. All
+        points are scattered into a stacked (N, H, W, C) grid with a few
+        vectorized calls instead of the per point loop of preprocess.
+
+        Parameters
+        ----------
+        pcd_np_list : list
+            List of raw lidar, np.ndarray.
+
+        Returns
+        -------
+        data_dict_list : list
+            The structured output dictionary of each frame, in order.
+        """
+        num_frames = len(pcd_np_list)
+        if num_frames == 0:
+            return []
+        bev = np.zeros((num_frames,) + tuple(self.geometry_param['input_shape']),
+                       dtype=np.float32)
+        pcd_raw = np.concatenate(pcd_np_list)
+        frame_ids = np.repeat(np.arange(num_frames),
+                              [pcd_np.shape[0] for pcd_np in pcd_np_list])
+        indices, in_grid = self._grid_indices(pcd_raw)
+        pcd_raw = pcd_raw[in_grid]
+        frame_ids = frame_ids[in_grid]
+        indices = indices[in_grid]
+
+        # if any point hit this voxel, set the voxel to 1
+        bev[frame_ids, indices[:, 0], indices[:, 1], indices[:, 2]] = 1
+
+        # average intensity of the points in each bev cell
+        cell_ids = np.ravel_multi_index(
+            (frame_ids, indices[:, 0], indices[:, 1]), bev.shape[:3])
+        num_cells = bev.shape[0] * bev.shape[1] * bev.shape[2]
+        intensity_sum = np.bincount(cell_ids, weights=pcd_raw[:, 3],
+                                    minlength=num_cells)
+        intensity_map_count = np.bincount(cell_ids, minlength=num_cells)
+        intensity = bev[..., -1].reshape(-1) + intensity_sum
+        divide_mask = intensity_map_count != 0
+        intensity[divide_mask] /= intensity_map_count[divide_mask]
+        bev[..., -1] = intensity.reshape(bev.shape[:3])
+
+        return [{"bev_input": np.transpose(bev[i], (2, 0, 1))} # (C,H,W)
+                for i in range(num_frames)]
+
+    def _grid_indices(self, pcd_raw):
+        """
+        Compute the bev cell of every point.
+
+        Parameters
+        ----------
+        pcd_raw : np.ndarray
+            The raw lidar.
+
+        Returns
+        -------
+        indices : np.ndarray
+            (N, 3) int cell indices along x, y and z.
+        in_grid : np.ndarray
+            (N,) bool mask of the points inside the grid, the points outside
+            would index a wrong cell or out of the bev map.
+        """
+        bev_origin = np.array(
+            [self.geometry_param["L1"], self.geometry_param["W1"],
+             self.geometry_param["H1"]]).reshape(1, -1)
+
+        indices = ((pcd_raw[:, :3] - bev_origin) / self.geometry_param[
+            "res"]).astype(int)
+        # the last channel holds the intensity, not a height bin
+        grid_shape = np.array(self.geometry_param['input_shape'][:3]) - \
+            np.array([0, 0, 1])
+        in_grid = np.all((indices >= 0) & (indices < grid_shape), axis=1)
+        return indices, in_grid
+
     @staticmethod
     def collate_batch_list(batch):
         """
@@ -2,8 +2,10 @@
 # Sizhe Wei <sizhewei@sjtu.edu.cn>
 
 import argparse
+import functools
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import OrderedDict
 import sys
 sys.path.append(os.getcwd())
@@ -12,10 +14,15 @@ import torch
 import open3d as o3d
 from torch.utils.data import DataLoader
 import numpy as np
+import matplotlib
+# the pngs are rendered in a worker thread, which the gui backends
+# (tk, qt) do not support, so pick the non interactive one before any
+# pyplot import
+matplotlib.use('Agg')
 
 import opencood.hypes_yaml.yaml_utils as yaml_utils
 from opencood.tools import train_utils, inference_utils
-from opencood.data_utils.datasets import build_dataset
+from opencood.data_utils.datasets import build_dataset, worker_init_fn
 from opencood.utils import eval_utils, box_utils
 from opencood.visualization import vis_utils, my_vis, simple_vis
 
@@ -43,14 +50,33 @@ def test_parser():
     parser.add_argument('--two_stage', help='whether to use two stage training', default=0, type=int)
     parser.add_argument('--config_suffix', default='', type=str, help='config suffix')
     parser.add_argument('--dataset', default='o', type=str, choices=['o', 'd'], help='which dataset will be used, o is for OPV2V/IRV2V, d is for DAIR-V2X.')
+    parser.add_argument('--test_batch_size', default=1, type=int,
+                        help='number of scenes in one forward pass, only '
+                             'for single stage intermediate fusion')
+    parser.add_argument('--fp16', action='store_true',
+                        help='run the model forward under cuda autocast, '
+                             'the post processing stays in float32')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile, '
+                             'needs pytorch >= 2.0')
+    parser.add_argument('--compile_backend', default='inductor', type=str,
+                        help='torch.compile backend, e.g. tensorrt once '
+                             'torch_tensorrt is installed')
     opt = parser.parse_args()
     return opt
 
 
+# torch.inference_mode is available since torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
 def main():
     opt = test_parser()
 
     assert opt.fusion_method in ['late', 'early', 'intermediate', 'no', 'no_w_uncertainty'] 
+    assert opt.test_batch_size == 1 or \
+        (opt.fusion_method == 'intermediate' and opt.two_stage == 0), \
+        'test_batch_size > 1 is only supported by single stage intermediate fusion'
 
     hypes = yaml_utils.load_yaml(None, opt, config_suffix=opt.config_suffix)
     
@@ -127,6 +153,26 @@ def main():
         model.load_state_dict(modified_pretrained_model_dict, strict=False)
     
     model.eval()
+    if opt.fp16 and torch.cuda.is_available():
+        model = inference_utils.AutocastModel(model)
+    if opt.compile:
+        assert hasattr(torch, 'compile'), 'torch.compile needs pytorch >= 2.0'
+        # the number of cavs and voxels changes between scenes, so no cuda
+        # graphs (mode='reduce-overhead') here
+        if opt.compile_backend in ('tensorrt', 'torch_tensorrt'):
+            # never used directly, importing it registers the tensorrt
+            # backends of torch.compile
+            import torch_tensorrt  # noqa: F401
+        model = torch.compile(model, backend=opt.compile_backend)
+    # the bev backbone sees the same feature map size in every scene, let
+    # cudnn pick the fastest conv algorithms
+    torch.backends.cudnn.benchmark = True
+    # tf32 tensor cores for the float32 matmuls and convs autocast does not
+    # cover, set_float32_matmul_precision is only in pytorch >= 1.12
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        torch.set_float32_matmul_precision('high')
 
     # setting noise
     np.random.seed(303)
@@ -138,13 +184,18 @@ def main():
     print(f"No Noise Added.")
     hypes.update({"noise_setting": noise_setting})
     opencood_dataset = build_dataset(hypes, visualize=True, train=False)
+    # multi-sweep samples are io heavy, keep enough of them in flight
+    num_workers = min(os.cpu_count() or 1, 8)
     data_loader = DataLoader(opencood_dataset,
-                            batch_size=1,
-                            num_workers=4,
+                            batch_size=opt.test_batch_size,
+                            num_workers=num_workers,
                             collate_fn=opencood_dataset.collate_batch_test,
                             shuffle=False,
-                            pin_memory=False,
-                            drop_last=False)
+                            pin_memory=True,
+                            drop_last=False,
+                            prefetch_factor=4,
+                            persistent_workers=True,
+                            worker_init_fn=worker_init_fn)
     
     # Create the dictionary for evaluation
     result_stat = {0.3: {'tp': [], 'fp': [], 'gt': 0, 'score': []},
@@ -153,7 +204,26 @@ def main():
     
     noise_level = "no_noise"
 
+    # create the output folders once instead of on every iteration
+    if opt.save_npy:
+        npy_save_path = os.path.join(opt.model_dir, 'npy')
+        os.makedirs(npy_save_path, exist_ok=True)
+        # all frames go into a few packed files, see load_prediction_gt
+        npy_writer = inference_utils.PredictionGtWriter(npy_save_path)
+    vis_save_path_root = os.path.join(opt.model_dir, f'vis_{opt.note}_%.2f_{noise_note}_roi_{num_roi_thres}'%(hypes['binomial_p']))
+    os.makedirs(vis_save_path_root, exist_ok=True)
+    if viz_bbx_flag:
+        box_save_folder = os.path.join(vis_save_path_root, 'bbx_folder')
+        os.makedirs(box_save_folder, exist_ok=True)
+
     start_time = time.time()
+    # gpu time of the loop, the events are queued on the stream and only
+    # synchronized once after the loop
+    use_cuda_timer = torch.cuda.is_available()
+    if use_cuda_timer:
+        start_event = torch.cuda.Event(enable_timing=True)
+        end_event = torch.cuda.Event(enable_timing=True)
+        start_event.record()
     # infer_info = opt.fusion_method + f"{opt.cavnum}agent" + opt.note
     i = -1
     avg_time_delay = 0.0
@@ -161,22 +231,86 @@ def main():
     avg_time_var = 0.0
     if opt.dataset == 'd':
         avg_cp_rate = 0.0
-    for i, batch_data in tenumerate(data_loader):
+    # resolve the inference function once instead of on every batch
+    if opt.fusion_method == 'intermediate' and opt.two_stage == 1:
+        infer_fn = functools.partial(inference_utils.inference_intermediate_fusion_flow_module,
+                                     viz_bbx_flag=viz_bbx_flag)
+    else:
+        infer_fn = {'late': inference_utils.inference_late_fusion,
+                    'early': inference_utils.inference_early_fusion,
+                    'intermediate': inference_utils.inference_intermediate_fusion,
+                    'no': inference_utils.inference_no_fusion,
+                    'no_w_uncertainty': inference_utils.inference_no_fusion_w_uncertainty}[opt.fusion_method]
+
+    # plain locals for everything the loop reads on every batch
+    fusion_method = opt.fusion_method
+    dataset_name = opt.dataset
+    save_npy = opt.save_npy
+    save_vis_interval = opt.save_vis_interval
+    test_batch_size = opt.test_batch_size
+    gt_range = hypes['postprocess']['gt_range']
+    late_sample_interval = hypes['time_delay']*100
+
+    # batches arrive on the device already, the copy of the next batch
+    # overlaps with the inference of the current one
+    # origin_lidar is only read by the npy saving and the visualization,
+    # both on the host, so it stays there
+    data_prefetcher = train_utils.DataPrefetcher(data_loader, device,
+                                                 host_keys=('origin_lidar',))
+    # a single worker renders the pngs in order, off the inference loop
+    vis_executor = ThreadPoolExecutor(max_workers=1)
+    vis_futures = []
+    cpu_device = torch.device('cpu')
+
+    def evaluate_scene(frame_idx, pred_box_tensor, pred_score, gt_box_tensor,
+                       origin_lidar, vis_name=None, uncertainty_tensor=None):
+        """
+        Accumulate the tp and fp of one scene, save its npy and queue its
+        bev png when vis_name is given.
+        """
+        eval_utils.caluclate_tp_fp_multi(pred_box_tensor,
+                                      pred_score,
+                                      gt_box_tensor,
+                                      result_stat,
+                                      (0.3, 0.5, 0.7))
+        if save_npy:
+            npy_writer.write(pred_box_tensor,
+                             gt_box_tensor,
+                             origin_lidar,
+                             frame_idx)
+        if vis_name is not None and pred_box_tensor is not None:
+            vis_save_path = os.path.join(vis_save_path_root, vis_name)
+            # copy to the host here, the rendering and png encoding run
+            # in the background while the next batch is inferred
+            vis_inputs = train_utils.to_device([pred_box_tensor,
+                                                gt_box_tensor,
+                                                origin_lidar],
+                                               cpu_device)
+            vis_futures.append(vis_executor.submit(simple_vis.visualize,
+                                *vis_inputs,
+                                gt_range,
+                                vis_save_path,
+                                method='bev',
+                                left_hand=left_hand,
+                                uncertainty=uncertainty_tensor.cpu() if uncertainty_tensor is not None else None))
+
+    for i, batch_data in tenumerate(data_prefetcher):
         if batch_data is None:
             continue
-        with torch.no_grad():
-            if opt.fusion_method == 'late':
-                if opt.dataset == 'o':
+        # inference_mode also skips the autograd version counters
+        with inference_mode():
+            if fusion_method == 'late':
+                if dataset_name == 'o':
                     unit_time_delay = []
                     unit_sample_interval = []
                     for cav_id, cav_content in batch_data.items():
                         unit_time_delay.append(cav_content['debug']['time_diff'])
-                        unit_sample_interval.append(hypes['time_delay']*100)
+                        unit_sample_interval.append(late_sample_interval)
                         # unit_sample_interval.append(cav_content['debug']['sample_interval'])
                     avg_time_delay += (sum(unit_time_delay[1:])/len(unit_time_delay[1:]))
                     avg_sample_interval += (float(sum(unit_sample_interval[1:]))/len(unit_sample_interval[1:]))
-            if opt.fusion_method == 'intermediate':
-                if opt.dataset == 'o':
+            if fusion_method == 'intermediate':
+                if dataset_name == 'o':
                     try:
                         avg_time_delay += batch_data['ego']['avg_time_delay']
                         avg_sample_interval += batch_data['ego']['avg_sample_interval']
@@ -187,7 +321,7 @@ def main():
                         avg_time_var += batch_data['ego']['avg_time_var']
                     except:
                         avg_time_var += -1
-                elif opt.dataset == 'd':
+                elif dataset_name == 'd':
                     try:
                         avg_time_delay += (-batch_data['ego']['avg_time_delay'])
                     except KeyError:
@@ -201,95 +335,46 @@ def main():
                     except KeyError:
                         avg_cp_rate += 1
                         
-            batch_data = train_utils.to_device(batch_data, device)
-            uncertainty_tensor = None
-            if opt.fusion_method == 'late':
-                pred_box_tensor, pred_score, gt_box_tensor = \
-                    inference_utils.inference_late_fusion(batch_data,
-                                                        model,
-                                                        opencood_dataset)
-            elif opt.fusion_method == 'early':
-                pred_box_tensor, pred_score, gt_box_tensor = \
-                    inference_utils.inference_early_fusion(batch_data,
-                                                        model,
-                                                        opencood_dataset)
-            elif opt.fusion_method == 'intermediate':
-                if opt.two_stage == 1:
-                    if viz_bbx_flag:
-                        pred_box_tensor, pred_score, gt_box_tensor, single_detection_bbx, matched_idx_list, compensated_results_list, single_updated_feature, single_original_feature, single_flow_map, single_reserved_mask, single_original_reserved_mask = \
-                            inference_utils.inference_intermediate_fusion_flow_module(batch_data,
-                                                                        model,
-                                                                        opencood_dataset, True)
-
-                    else:
-                        pred_box_tensor, pred_score, gt_box_tensor = \
-                            inference_utils.inference_intermediate_fusion_flow_module(batch_data,
-                                                                        model,
-                                                                        opencood_dataset)
-                else:
-                    pred_box_tensor, pred_score, gt_box_tensor = \
-                        inference_utils.inference_intermediate_fusion(batch_data,
+            if test_batch_size > 1:
+                # one forward pass for the batch, evaluated scene by scene
+                scene_results = inference_utils.inference_intermediate_fusion_batch(batch_data,
                                                                     model,
                                                                     opencood_dataset)
-            elif opt.fusion_method == 'no':
-                pred_box_tensor, pred_score, gt_box_tensor = \
-                    inference_utils.inference_no_fusion(batch_data,
-                                                                model,
-                                                                opencood_dataset)
-            elif opt.fusion_method == 'no_w_uncertainty':
-                pred_box_tensor, pred_score, gt_box_tensor, uncertainty_tensor = \
-                    inference_utils.inference_no_fusion_w_uncertainty(batch_data,
-                                                                model,
-                                                                opencood_dataset)
-            else:
-                raise NotImplementedError('Only no, no_w_uncertainty, early, late and intermediate'
-                                        'fusion is supported.')
+                for b, (pred_box_tensor, pred_score, gt_box_tensor) in enumerate(scene_results):
+                    frame_idx = i * test_batch_size + b
+                    vis_name = 'bev_%05d.png' % frame_idx \
+                        if frame_idx % save_vis_interval == 0 else None
+                    evaluate_scene(frame_idx, pred_box_tensor, pred_score,
+                                   gt_box_tensor,
+                                   batch_data['ego']['origin_lidar'][b],
+                                   vis_name)
+                continue
+
+            uncertainty_tensor = None
+            infer_output = infer_fn(batch_data, model, opencood_dataset)
+            pred_box_tensor, pred_score, gt_box_tensor = infer_output[:3]
+            if fusion_method == 'no_w_uncertainty':
+                uncertainty_tensor = infer_output[3]
+            elif len(infer_output) > 3:
+                # flow module with viz_bbx_flag
+                single_detection_bbx, matched_idx_list, compensated_results_list, single_updated_feature, single_original_feature, single_flow_map, single_reserved_mask, single_original_reserved_mask = \
+                    infer_output[3:]
             
             
-            eval_utils.caluclate_tp_fp(pred_box_tensor,
-                                    pred_score,
-                                    gt_box_tensor,
-                                    result_stat,
-                                    0.3)
-            eval_utils.caluclate_tp_fp(pred_box_tensor,
-                                    pred_score,
-                                    gt_box_tensor,
-                                    result_stat,
-                                    0.5)
-            eval_utils.caluclate_tp_fp(pred_box_tensor,
-                                    pred_score,
-                                    gt_box_tensor,
-                                    result_stat,
-                                    0.7)
-            if opt.save_npy:
-                npy_save_path = os.path.join(opt.model_dir, 'npy')
-                if not os.path.exists(npy_save_path):
-                    os.makedirs(npy_save_path)
-                inference_utils.save_prediction_gt(pred_box_tensor,
-                                                gt_box_tensor,
-                                                batch_data['ego']['origin_lidar'][0],
-                                                i,
-                                                npy_save_path)
-
-            if (i % opt.save_vis_interval == 0) and (pred_box_tensor is not None):
-                vis_save_path_root = os.path.join(opt.model_dir, f'vis_{opt.note}_%.2f_{noise_note}_roi_{num_roi_thres}'%(hypes['binomial_p']))
-                if not os.path.exists(vis_save_path_root):
-                    os.makedirs(vis_save_path_root)
-
+            vis_name = None
+            if i % save_vis_interval == 0:
                 try:
                     debug_path = batch_data['ego']['debug']['scene_name'] + '_' + batch_data['ego']['debug']['cav_id'] + '_' + batch_data['ego']['debug']['timestamp']
                     # print(debug_path)
                 except:
                     debug_path = 'path'
-                vis_save_path = os.path.join(vis_save_path_root, 'bev_%05d_%s.png' % (i, debug_path))
-                simple_vis.visualize(pred_box_tensor,
-                                    gt_box_tensor,
-                                    batch_data['ego']['origin_lidar'][0],
-                                    hypes['postprocess']['gt_range'],
-                                    vis_save_path,
-                                    method='bev',
-                                    left_hand=left_hand,
-                                    uncertainty=uncertainty_tensor)
+                vis_name = 'bev_%05d_%s.png' % (i, debug_path)
+            evaluate_scene(i, pred_box_tensor, pred_score, gt_box_tensor,
+                           batch_data['ego']['origin_lidar'][0],
+                           vis_name,
+                           uncertainty_tensor)
+
+            if (vis_name is not None) and (pred_box_tensor is not None):
                 if viz_bbx_flag:
                     '''
                     box_dict : {
@@ -320,7 +405,7 @@ def main():
                     box_dict.update({
                         'single_lidar': batch_data['ego']['single_lidar_list'], # len = N, (n_lidar, 3)
                         'single_past_lidar': batch_data['ego']['single_past_lidar_list'], 
-                        'gt_range': hypes['postprocess']['gt_range'],
+                        'gt_range': gt_range,
                         'lidar_pose_current': batch_data['ego']['curr_lidar_pose'], #[N, 6] 
                         'lidar_pose_0': batch_data['ego']['past_lidar_pose'][:, 0, :], # (N, 6)
                         'pred_box_tensor': pred_box_tensor,
@@ -337,9 +422,6 @@ def main():
                         'gt_range': # [-140.8, -40, -3, 140.8, 40, 1], 表示lidar的范围
                     }
                     '''
-                    box_save_folder = os.path.join(vis_save_path_root, 'bbx_folder')
-                    if not os.path.exists(box_save_folder):
-                        os.mkdir(box_save_folder)
                     box_save_path = os.path.join(box_save_folder, 'bbx_%05d_%s.pt' % (i, debug_path))
                     torch.save(box_dict, box_save_path)
 
@@ -370,21 +452,44 @@ def main():
                     #     os.mkdir(box_save_folder)
                     # box_save_path = os.path.join(box_save_folder, 'bbx_%05d_%s.pt' % (i, debug_path))
                     # torch.save(box_dict, box_save_path)
-        torch.cuda.empty_cache()
-    end_time = time.time()
-    print("Time Consumed: %.2f minutes" % ((end_time - start_time)/60))
-        
+    if use_cuda_timer:
+        end_event.record()
+
+    # the final ap evaluation only reads result_stat, so it runs in the
+    # background while the pending pngs and npy files are finished
+    eval_executor = ThreadPoolExecutor(max_workers=1)
+    # the delay statistics are summed once per batch and averaged over the
+    # batches, with test_batch_size > 1 each batch reports the mean of its
+    # scenes, so these are means of the batch means, not per frame values
+    if test_batch_size > 1:
+        print('Delay statistics are averaged per batch of %d scenes'
+              % test_batch_size)
     if opt.dataset == 'o':
         avg_time_delay = (avg_time_delay/i) * 50 # unit is ms
         avg_sample_interval /= i
         avg_time_var /= i
-        ap30, ap50, ap70 = eval_utils.eval_final_results(result_stat,
+        eval_future = eval_executor.submit(eval_utils.eval_final_results, result_stat,
                                     opt.model_dir, noise_level, avg_time_delay, avg_sample_interval, avg_time_var, opt.note+'_'+str("%.2f"%hypes['binomial_p'])+f'_{noise_note}_roi_{num_roi_thres}')
     elif opt.dataset == 'd':
         avg_sample_interval /= i
         avg_cp_rate /= i
-        ap30, ap50, ap70 = eval_utils.eval_final_results(result_stat,
+        eval_future = eval_executor.submit(eval_utils.eval_final_results, result_stat,
                                     opt.model_dir, noise_level=noise_level, avg_time_delay=avg_cp_rate, avg_sample_interval=avg_sample_interval, note=opt.note+'_'+str("%.2f"%hypes['binomial_p'])+f'_{noise_note}_roi_{num_roi_thres}', dataset=opt.dataset)
+
+    # wait for the pending pngs and raise the errors of the rendering
+    for future in vis_futures:
+        future.result()
+    vis_executor.shutdown(wait=True)
+    if opt.save_npy:
+        npy_writer.close()
+    if use_cuda_timer:
+        torch.cuda.synchronize()
+        print("GPU Time Consumed: %.2f minutes" % (start_event.elapsed_time(end_event)/1000/60))
+    end_time = time.time()
+    print("Time Consumed: %.2f minutes" % ((end_time - start_time)/60))
+
+    ap30, ap50, ap70 = eval_future.result()
+    eval_executor.shutdown()
     print("Module with sample interval expection: {}".format(hypes['binomial_n']*hypes['binomial_p']))
     if opt.dataset == 'o':
         print(f"IR sample range is {hypes['ir_range']}")
@@ -342,6 +342,102 @@ def inference_intermediate_fusion(batch_data, model, dataset):
     return inference_early_fusion(batch_data, model, dataset)
 
 
+def inference_intermediate_fusion_batch(batch_data, model, dataset):
+    """
+    Model inference for intermediate fusion with several scenes in one
+    batch. The model runs once on the whole batch, the post processing
+    runs scene by scene.
+
+    Parameters
+    ----------
+    batch_data : dict
+    model : opencood.object
+    dataset : opencood.IntermediateFusionDataset
+
+    Returns
+    -------
+    scene_results : list
+        (pred_box_tensor, pred_score, gt_box_tensor) of every scene.
+    """
+    output_dict = OrderedDict()
+    cav_content = batch_data['ego']
+    output_dict['ego'] = model(cav_content)
+
+    return [dataset.post_process(scene_data, scene_output)
+            for scene_data, scene_output in
+            split_batch_scenes(batch_data, output_dict)]
+
+
+# per scene entries of a collated test batch, sliced along their first
+# (batch) dim by split_batch_scenes
+SCENE_DATA_KEYS = ('object_bbx_center', 'object_bbx_mask', 'record_len',
+                   'pairwise_t_matrix', 'origin_lidar')
+# entries shared by all scenes of a batch, (4, 4) matrices and the anchors
+SHARED_DATA_KEYS = ('anchor_box', 'transformation_matrix',
+                    'transformation_matrix_clean')
+# dense head outputs read by the post processor, (B, C, H, W)
+SCENE_OUTPUT_KEYS = ('psm', 'rm', 'dm')
+
+
+def split_batch_scenes(batch_data, output_dict):
+    """
+    Split a collated test batch and the fused model output into the
+    batch size 1 dicts the post processor expects. Only the keys listed in
+    SCENE_DATA_KEYS, SHARED_DATA_KEYS and SCENE_OUTPUT_KEYS are passed on,
+    a per scene entry that does not have one row per scene raises.
+
+    Parameters
+    ----------
+    batch_data : dict
+        The collated batch, with the per scene 'object_ids_list'.
+    output_dict : dict
+        The model output, dense head outputs are (B, C, H, W).
+
+    Returns
+    -------
+    A generator of (scene_data, scene_output) for every scene.
+    """
+    ego_data = batch_data['ego']
+    ego_output = output_dict['ego']
+    batch_size = ego_data['object_bbx_center'].shape[0]
+
+    scene_data_keys = [k for k in SCENE_DATA_KEYS if k in ego_data]
+    scene_output_keys = [k for k in SCENE_OUTPUT_KEYS if k in ego_output]
+    for k in scene_data_keys:
+        check_scene_rows(k, ego_data[k], batch_size)
+    for k in scene_output_keys:
+        check_scene_rows(k, ego_output[k], batch_size)
+    if len(ego_data['object_ids_list']) != batch_size:
+        raise ValueError('object_ids_list has %d entries for %d scenes'
+                         % (len(ego_data['object_ids_list']), batch_size))
+
+    shared_data = {}
+    for k in SHARED_DATA_KEYS:
+        if k not in ego_data:
+            continue
+        if k != 'anchor_box' and ego_data[k].dim() != 2:
+            raise ValueError('%s of shape %s is not shared by the scenes of '
+                             'the batch' % (k, tuple(ego_data[k].shape)))
+        shared_data[k] = ego_data[k]
+
+    for b in range(batch_size):
+        scene_data = dict(shared_data)
+        scene_data.update({k: ego_data[k][b:b + 1] for k in scene_data_keys})
+        scene_data['object_ids'] = ego_data['object_ids_list'][b]
+
+        scene_output = {k: ego_output[k][b:b + 1] for k in scene_output_keys}
+        yield OrderedDict(ego=scene_data), OrderedDict(ego=scene_output)
+
+
+def check_scene_rows(key, value, batch_size):
+    """
+    Raise if a per scene entry does not have one row per scene.
+    """
+    if value.shape[0] != batch_size:
+        raise ValueError('%s has %d rows, expected one per scene (%d)'
+                         % (key, value.shape[0], batch_size))
+
+
 def save_prediction_gt(pred_tensor, gt_tensor, pcd, timestamp, save_path):
     """
     Save prediction and gt tensor to txt file.
@@ -353,3 +449,123 @@ def save_prediction_gt(pred_tensor, gt_tensor, pcd, timestamp, save_path):
     np.save(os.path.join(save_path, '%04d_pcd.npy' % timestamp), pcd_np)
     np.save(os.path.join(save_path, '%04d_pred.npy' % timestamp), pred_np)
     np.save(os.path.join(save_path, '%04d_gt.npy' % timestamp), gt_np)
+
+
+class PredictionGtWriter(object):
+    """
+    Append the point cloud, prediction and gt of every frame to three
+    packed float32 files, instead of writing three small npy files per
+    frame like save_prediction_gt. The frame ids, the row counts and the
+    row shapes are saved in index.npz by close(), load_prediction_gt reads
+    the frames back.
+
+    Parameters
+    ----------
+    save_path : str
+        The folder to write pcd.bin, pred.bin, gt.bin and index.npz to.
+    """
+    names = ('pcd', 'pred', 'gt')
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.files = {name: open(os.path.join(save_path, '%s.bin' % name),
+                                 'wb')
+                      for name in self.names}
+        self.row_shapes = {}
+        self.index = []
+
+    def write(self, pred_tensor, gt_tensor, pcd, timestamp):
+        row = [timestamp]
+        for name, tensor in zip(self.names, (pcd, pred_tensor, gt_tensor)):
+            if tensor is None:
+                row.append(0)
+                continue
+            array = np.ascontiguousarray(torch_tensor_to_numpy(tensor),
+                                         dtype=np.float32)
+            if array.size > 0:
+                # np.memmap can not map an empty file, so only files with
+                # data get a row shape
+                self.row_shapes.setdefault(name, array.shape[1:])
+            self.files[name].write(array.tobytes())
+            row.append(array.shape[0])
+        self.index.append(row)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.savez(os.path.join(self.save_path, 'index.npz'),
+                 index=np.array(self.index, dtype=np.int64).reshape(-1, 4),
+                 **{'%s_shape' % name: np.array(shape, dtype=np.int64)
+                    for name, shape in self.row_shapes.items()})
+
+
+def load_prediction_gt(save_path):
+    """
+    Read the frames written by PredictionGtWriter.
+
+    Parameters
+    ----------
+    save_path : str
+        The folder PredictionGtWriter wrote to.
+
+    Returns
+    -------
+    frames : OrderedDict
+        timestamp -> {'pcd', 'pred', 'gt'} arrays, memory mapped.
+    """
+    meta = np.load(os.path.join(save_path, 'index.npz'))
+    index = meta['index']
+    frames = OrderedDict((int(t), {}) for t in index[:, 0])
+    for i, name in enumerate(PredictionGtWriter.names):
+        if '%s_shape' % name not in meta:
+            for frame in frames.values():
+                frame[name] = None
+            continue
+        row_shape = tuple(meta['%s_shape' % name])
+        data = np.memmap(os.path.join(save_path, '%s.bin' % name),
+                         dtype=np.float32, mode='r')
+        data = data.reshape((-1,) + row_shape)
+        offsets = np.concatenate([[0], np.cumsum(index[:, i + 1])])
+        for j, frame in enumerate(frames.values()):
+            frame[name] = data[offsets[j]:offsets[j + 1]]
+    return frames
+
+
+def to_float(inputs):
+    """
+    Cast the half precision tensors in the (nested) inputs back to float32.
+    """
+    if isinstance(inputs, dict):
+        return inputs.__class__((k, to_float(v)) for k, v in inputs.items())
+    elif isinstance(inputs, (list, tuple)):
+        return inputs.__class__(to_float(x) for x in inputs)
+    elif isinstance(inputs, torch.Tensor) and \
+            inputs.dtype in (torch.float16, torch.bfloat16):
+        return inputs.float()
+    return inputs
+
+
+class AutocastModel(torch.nn.Module):
+    """
+    Run the forward pass of the wrapped model under cuda autocast. The
+    outputs are cast back to float32, so the post processing (box decoding,
+    nms and iou) still runs in full precision.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model to wrap.
+
+    dtype : torch.dtype
+        torch.float16 or torch.bfloat16.
+    """
+
+    def __init__(self, model, dtype=torch.float16):
+        super(AutocastModel, self).__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, *args, **kwargs):
+        with torch.cuda.amp.autocast(dtype=self.dtype):
+            output = self.model(*args, **kwargs)
+        return to_float(output)
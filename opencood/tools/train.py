@@ -16,7 +16,7 @@ from tensorboardX import SummaryWriter
 import importlib
 import opencood.hypes_yaml.yaml_utils as yaml_utils
 from opencood.tools import train_utils
-from opencood.data_utils.datasets import build_dataset
+from opencood.data_utils.datasets import build_dataset, worker_init_fn
 
 from tqdm import tqdm
 from tqdm.contrib import tenumerate
@@ -70,14 +70,16 @@ def main():
                             collate_fn=opencood_train_dataset.collate_batch_train,
                             shuffle=True,
                             pin_memory=True,
-                            drop_last=True)
+                            drop_last=True,
+                            worker_init_fn=worker_init_fn)
     val_loader = DataLoader(opencood_validate_dataset,
                             batch_size=hypes['train_params']['batch_size'],
                             num_workers=16,
                             collate_fn=opencood_train_dataset.collate_batch_train,
                             shuffle=True,
                             pin_memory=True,
-                            drop_last=True)
+                            drop_last=True,
+                            worker_init_fn=worker_init_fn)
     end_time = time.time()
     print("=== Time consumed: %.1f minutes. ===" % ((end_time - start_time)/60))
     start_time = time.time()
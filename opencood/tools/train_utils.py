@@ -463,11 +463,11 @@ def setup_lr_schedular(hypes, optimizer, init_epoch=None):
     return scheduler
 
 
-def to_device(inputs, device):
+def to_device(inputs, device, non_blocking=False):
     if isinstance(inputs, list):
-        return [to_device(x, device) for x in inputs]
+        return [to_device(x, device, non_blocking) for x in inputs]
     elif isinstance(inputs, dict):        
-        return {k: to_device(v, device) for k, v in inputs.items()}
+        return {k: to_device(v, device, non_blocking) for k, v in inputs.items()}
     else:
         if isinstance(inputs, int) or isinstance(inputs, float) \
                 or isinstance(inputs, str) or isinstance(inputs, numpy.int64):  
@@ -475,4 +475,88 @@ def to_device(inputs, device):
                 # sizhewei @ 2022/10/04
                 # 添加类型 numpy.int64 数据集中的 sample_idx 是此类型, numpy.ndarry 数据集中 time_interval 是此类型
             return inputs
+        if non_blocking:
+            return inputs.to(device, non_blocking=True)
         return inputs.to(device)
+
+
+def record_stream(inputs, stream):
+    """
+    Mark all cuda tensors in the (nested) inputs as used by the stream, so
+    that their memory is not reused before the work queued on it is done.
+    """
+    if isinstance(inputs, list):
+        for x in inputs:
+            record_stream(x, stream)
+    elif isinstance(inputs, dict):
+        for x in inputs.values():
+            record_stream(x, stream)
+    elif isinstance(inputs, torch.Tensor) and inputs.is_cuda:
+        inputs.record_stream(stream)
+
+
+class DataPrefetcher(object):
+    """
+    Iterate over a dataloader with the batches already moved to the device.
+    On cuda, the copy of the next batch is issued on a side stream while
+    the current batch is processed, which needs pin_memory=True in the
+    dataloader to be asynchronous.
+
+    Parameters
+    ----------
+    loader : torch.utils.data.DataLoader
+        The dataloader to wrap. None batches are passed through.
+
+    device : torch.device
+        The target device.
+
+    host_keys : tuple
+        Keys of the per cav dicts that are only read on the host, e.g.
+        origin_lidar for visualization, and are not copied to the device.
+    """
+
+    def __init__(self, loader, device, host_keys=()):
+        self.loader = loader
+        self.device = device
+        self.host_keys = host_keys
+        if device.type == 'cuda':
+            self.stream = torch.cuda.Stream()
+        else:
+            self.stream = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        has_next, next_batch = self.preload(loader_iter)
+        while has_next:
+            batch = next_batch
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream()
+                current_stream.wait_stream(self.stream)
+                record_stream(batch, current_stream)
+            # queue the copy of the following batch before handing this one out
+            has_next, next_batch = self.preload(loader_iter)
+            yield batch
+
+    def preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return False, None
+        if batch is None:
+            return True, None
+        host_items = {}
+        for cav_id, cav_content in batch.items():
+            for key in self.host_keys:
+                if isinstance(cav_content, dict) and key in cav_content:
+                    host_items[(cav_id, key)] = cav_content.pop(key)
+        if self.stream is None:
+            batch = to_device(batch, self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                batch = to_device(batch, self.device, non_blocking=True)
+        for (cav_id, key), value in host_items.items():
+            batch[cav_id][key] = value
+        return True, batch
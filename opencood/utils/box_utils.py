@@ -914,6 +914,28 @@ def project_points_by_matrix_torch(points, transformation_matrix):
         else projected_points[:, :3].numpy()
 
 
+def project_points_by_matrix(points, transformation_matrix):
+    """
+    Numpy version of project_points_by_matrix_torch. The rotation and the
+    translation are applied directly in float32, which avoids the torch
+    round trip and the homogeneous padding for numpy inputs.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        3D points, (N, 3)
+    transformation_matrix : np.ndarray
+        Transformation matrix, (4, 4)
+    Returns
+    -------
+    projected_points : np.ndarray
+        The projected points, (N, 3), float32
+    """
+    transformation_matrix = transformation_matrix.astype(np.float32)
+    return np.asarray(points, dtype=np.float32) @ transformation_matrix[:3, :3].T + \
+        transformation_matrix[:3, 3]
+
+
 def box_encode(
         boxes,
         anchors,
@@ -4,9 +4,11 @@
 
 
 import os
+import warnings
 
 import numpy as np
 import torch
+from numba import njit, prange
 
 from opencood.utils import common_utils
 from opencood.hypes_yaml import yaml_utils
@@ -93,6 +95,246 @@ def caluclate_tp_fp(det_boxes, det_score, gt_boxes, result_stat, iou_thresh):
     result_stat[iou_thresh]['gt'] += gt
 
 
+def caluclate_tp_fp_multi(det_boxes, det_score, gt_boxes, result_stat,
+                          iou_threshs=(0.3, 0.5, 0.7)):
+    """
+    Same as caluclate_tp_fp, but for several iou thresholds at once. The
+    iou between every prediction and every gt box is computed only once and
+    the greedy matching is repeated on the iou matrix for each threshold.
+
+    Parameters
+    ----------
+    det_boxes : torch.Tensor
+        The detection bounding box, shape (N, 8, 3) or (N, 4, 2).
+    det_score :torch.Tensor
+        The confidence score for each preditect bounding box.
+    gt_boxes : torch.Tensor
+        The groundtruth bounding box.
+    result_stat: dict
+        A dictionary contains fp, tp and gt number.
+    iou_threshs : tuple
+        The iou threshs.
+    """
+    gt = gt_boxes.shape[0]
+    # frames without detections only count their gt boxes, no copy to the
+    # host and no iou needed
+    if det_boxes is None or det_boxes.shape[0] == 0:
+        for iou_thresh in iou_threshs:
+            result_stat[iou_thresh]['gt'] += gt
+        return
+
+    det_score, det_corners, gt_corners = \
+        sorted_bev_corners_to_numpy(det_boxes, det_score, gt_boxes)
+
+    # (N, M) iou matrix, rows follow the descending score order
+    ious = bev_iou_matrix(det_corners, gt_corners)
+
+    # one array per frame instead of one python number per box, they are
+    # concatenated once in calculate_ap
+    for iou_thresh in iou_threshs:
+        tp = match_tp(ious, iou_thresh)
+        result_stat[iou_thresh]['score'].append(det_score)
+        result_stat[iou_thresh]['tp'].append(tp)
+        result_stat[iou_thresh]['fp'].append(1 - tp)
+        result_stat[iou_thresh]['gt'] += gt
+
+
+def sorted_bev_corners_to_numpy(det_boxes, det_score, gt_boxes):
+    """
+    Sort the predictions by score on their device and copy the scores and
+    the bev corners of the predictions and the gt boxes to the host with a
+    single transfer.
+
+    Parameters
+    ----------
+    det_boxes : torch.Tensor
+        The detection bounding box, shape (N, 8, 3) or (N, 4, 2).
+    det_score :torch.Tensor
+        The confidence score for each preditect bounding box.
+    gt_boxes : torch.Tensor
+        The groundtruth bounding box.
+
+    Returns
+    -------
+    det_score : np.ndarray
+        The scores in descending order.
+    det_corners : np.ndarray
+        (N, 4, 2) float64 bev corners of the sorted predictions.
+    gt_corners : np.ndarray
+        (M, 4, 2) float64 bev corners of the gt boxes.
+    """
+    score_order_descend = torch.argsort(-det_score.reshape(-1))
+    det_corners = det_boxes[score_order_descend, :4, :2].reshape(-1)
+    gt_corners = gt_boxes[:, :4, :2].reshape(-1).to(det_boxes.device)
+    # one blocking copy instead of one per tensor
+    flat = torch.cat([det_score.reshape(-1)[score_order_descend].double(),
+                      det_corners.double(),
+                      gt_corners.double()]).cpu().numpy()
+
+    n_det = score_order_descend.shape[0]
+    det_score = flat[:n_det]
+    det_corners = flat[n_det:n_det * 9].reshape(-1, 4, 2)
+    gt_corners = flat[n_det * 9:].reshape(-1, 4, 2)
+    return det_score, det_corners, gt_corners
+
+
+@njit(cache=True)
+def _polygon_area(xs, ys, n):
+    area = 0.
+    for i in range(n):
+        j = (i + 1) % n
+        area += xs[i] * ys[j] - xs[j] * ys[i]
+    return 0.5 * area
+
+
+@njit(cache=True)
+def _convex_iou(box_a, box_b):
+    """
+    Iou of two convex quadrilaterals (4, 2), the intersection is found by
+    clipping box_a with every edge of box_b (Sutherland-Hodgman).
+    """
+    ax = box_a[:, 0].copy()
+    ay = box_a[:, 1].copy()
+    bx = box_b[:, 0].copy()
+    by = box_b[:, 1].copy()
+    area_a = _polygon_area(ax, ay, 4)
+    area_b = _polygon_area(bx, by, 4)
+    # the clipping below expects both polygons counter clockwise
+    if area_a < 0:
+        ax = ax[::-1].copy()
+        ay = ay[::-1].copy()
+        area_a = -area_a
+    if area_b < 0:
+        bx = bx[::-1].copy()
+        by = by[::-1].copy()
+        area_b = -area_b
+
+    # a quadrilateral clipped by 4 half planes has at most 8 vertices
+    xs = np.empty(16)
+    ys = np.empty(16)
+    out_x = np.empty(16)
+    out_y = np.empty(16)
+    xs[:4] = ax
+    ys[:4] = ay
+    n = 4
+    for k in range(4):
+        ex0 = bx[k]
+        ey0 = by[k]
+        ex1 = bx[(k + 1) % 4]
+        ey1 = by[(k + 1) % 4]
+        m = 0
+        for i in range(n):
+            sx = xs[i - 1] if i > 0 else xs[n - 1]
+            sy = ys[i - 1] if i > 0 else ys[n - 1]
+            side_s = (ex1 - ex0) * (sy - ey0) - (ey1 - ey0) * (sx - ex0)
+            side_e = (ex1 - ex0) * (ys[i] - ey0) - (ey1 - ey0) * (xs[i] - ex0)
+            if side_e >= 0:
+                if side_s < 0:
+                    t = side_s / (side_s - side_e)
+                    out_x[m] = sx + t * (xs[i] - sx)
+                    out_y[m] = sy + t * (ys[i] - sy)
+                    m += 1
+                out_x[m] = xs[i]
+                out_y[m] = ys[i]
+                m += 1
+            elif side_s >= 0:
+                t = side_s / (side_s - side_e)
+                out_x[m] = sx + t * (xs[i] - sx)
+                out_y[m] = sy + t * (ys[i] - sy)
+                m += 1
+        n = m
+        xs[:n] = out_x[:n]
+        ys[:n] = out_y[:n]
+        if n == 0:
+            return 0.
+
+    inter = _polygon_area(xs, ys, n)
+    union = area_a + area_b - inter
+    if union <= 0:
+        return 0.
+    return inter / union
+
+
+@njit(parallel=True, cache=True)
+def _iou_matrix_kernel(det_corners, gt_corners, ious):
+    for i in prange(det_corners.shape[0]):
+        for j in range(gt_corners.shape[0]):
+            ious[i, j] = _convex_iou(det_corners[i], gt_corners[j])
+
+
+def bev_iou_matrix(det_corners, gt_corners):
+    """
+    Compute the bev iou between every prediction and every gt box.
+
+    Parameters
+    ----------
+    det_corners : np.ndarray
+        The bev corners of the predictions, shape (N, 4, 2).
+    gt_corners : np.ndarray
+        The bev corners of the gt boxes, shape (M, 4, 2).
+
+    Returns
+    -------
+    ious : np.ndarray
+        The float64 iou matrix of shape (N, M).
+    """
+    ious = np.zeros((det_corners.shape[0], gt_corners.shape[0]),
+                    dtype=np.float64)
+    if ious.size > 0:
+        _iou_matrix_kernel(det_corners, gt_corners, ious)
+    return ious
+
+
+@njit(cache=True)
+def _match_tp_kernel(ious, iou_thresh, tp):
+    used = np.zeros(ious.shape[1], dtype=np.bool_)
+    for i in range(ious.shape[0]):
+        best = -1.
+        gt_index = -1
+        for j in range(ious.shape[1]):
+            if not used[j] and ious[i, j] > best:
+                best = ious[i, j]
+                gt_index = j
+        if gt_index < 0 or best < iou_thresh:
+            continue
+        tp[i] = 1
+        used[gt_index] = True
+
+
+def match_tp(ious, iou_thresh):
+    """
+    Greedily match the score sorted predictions to the gt boxes, a matched
+    gt box can not be matched again.
+
+    Parameters
+    ----------
+    ious : np.ndarray
+        The iou matrix of shape (N, M), rows sorted by descending score.
+    iou_thresh : float
+        The iou thresh.
+
+    Returns
+    -------
+    tp : np.ndarray
+        (N,) int array, 1 for true positive and 0 for false positive.
+    """
+    tp = np.zeros(ious.shape[0], dtype=np.int64)
+    if ious.shape[1] > 0:
+        _match_tp_kernel(ious, iou_thresh, tp)
+    return tp
+
+
+def _flatten_stat(values):
+    """
+    Concatenate the tp, fp or score entries of result_stat, which may be
+    per box numbers (caluclate_tp_fp) or per frame arrays
+    (caluclate_tp_fp_multi).
+    """
+    if len(values) == 0:
+        return np.zeros(0)
+    return np.concatenate([np.atleast_1d(v) for v in values])
+
+
 def calculate_ap(result_stat, iou):
     """
     Calculate the average precision and recall, and save them into a txt.
@@ -105,34 +347,24 @@ def calculate_ap(result_stat, iou):
     """
     iou_5 = result_stat[iou]
 
-    fp = np.array(iou_5['fp'])
-    tp = np.array(iou_5['tp'])
-    score = np.array(iou_5['score'])
+    fp = _flatten_stat(iou_5['fp'])
+    tp = _flatten_stat(iou_5['tp'])
+    score = _flatten_stat(iou_5['score'])
     assert len(fp) == len(tp) and len(tp) == len(score)
 
     sorted_index = np.argsort(-score)
-    fp = fp[sorted_index].tolist()
-    tp = tp[sorted_index].tolist()
+    fp = np.cumsum(fp[sorted_index], dtype=np.float64)
+    tp = np.cumsum(tp[sorted_index], dtype=np.float64)
 
     gt_total = iou_5['gt']
-
-    cumsum = 0
-    for idx, val in enumerate(fp):
-        fp[idx] += cumsum
-        cumsum += val
-
-    cumsum = 0
-    for idx, val in enumerate(tp):
-        tp[idx] += cumsum
-        cumsum += val
-
-    rec = tp[:]
-    for idx, val in enumerate(tp):
-        rec[idx] = float(tp[idx]) / gt_total
-
-    prec = tp[:]
-    for idx, val in enumerate(tp):
-        prec[idx] = float(tp[idx]) / (fp[idx] + tp[idx])
+    if gt_total == 0:
+        # recall is undefined without gt boxes, report 0 instead of nan
+        warnings.warn('No gt boxes for the AP at IOU %.2f, it is set to 0'
+                      % iou)
+        return voc_ap([], [])
+
+    rec = (tp / gt_total).tolist()
+    prec = (tp / (fp + tp)).tolist()
 
     ap, mrec, mprec = voc_ap(rec[:], prec[:])
 
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# License: TDG-Attribution-NonCommercial-NoDistrib
+
+
+"""
+File io helpers shared by the datasets
+"""
+
+import os
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyThreadPool(object):
+    """
+    A ThreadPoolExecutor created on first use in each process. A forked
+    dataloader worker creates its own pool instead of using the threads of
+    the parent, and pickling for spawned workers drops the pool.
+
+    Parameters
+    ----------
+    max_workers : int
+        The number of threads of the pool.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._pool = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'max_workers': self.max_workers, '_pool': None, '_pid': None}
+
+    def get(self):
+        """
+        Return the thread pool of the current process.
+        """
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._pid = os.getpid()
+        return self._pool
+
+
+@contextlib.contextmanager
+def atomic_open(path):
+    """
+    Open a temporary file next to path for binary writing and move it to
+    path with os.replace once the block succeeds, so processes reading path
+    concurrently never see a partial file. Raises OSError like open.
+
+    Parameters
+    ----------
+    path : str
+        The file to write.
+    """
+    tmp_file = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            yield f
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
@@ -88,6 +88,37 @@ def mask_ego_points(points):
     return points
 
 
+def mask_ego_and_range_points(points, limit_range):
+    """
+    Remove the lidar points of the ego vehicle itself and the ones out of the
+    boundary in a single pass, equals to
+    mask_points_by_range(mask_ego_points(points), limit_range).
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Lidar points under lidar sensor coordinate system.
+
+    limit_range : list
+        [x_min, y_min, z_min, x_max, y_max, z_max]
+
+    Returns
+    -------
+    points : np.ndarray
+        Filtered lidar points.
+    """
+    x = points[:, 0]
+    y = points[:, 1]
+    z = points[:, 2]
+    mask = (x > limit_range[0]) & (x < limit_range[3]) \
+           & (y > limit_range[1]) & (y < limit_range[4]) \
+           & (z > limit_range[2]) & (z < limit_range[5])
+    ego_mask = (x >= -1.95) & (x <= 2.95) & (y >= -1.1) & (y <= 1.1)
+    mask &= ~ego_mask
+
+    return points[mask]
+
+
 def shuffle_points(points):
     shuffle_idx = np.random.permutation(points.shape[0])
     points = points[shuffle_idx]
@@ -177,6 +208,37 @@ def downsample_lidar(pcd_np, num):
     return pcd_np
 
 
+def downsample_lidar_voxel(pcd_np, voxel_size):
+    """
+    Downsample the lidar points with a voxel grid, keeping the first point
+    that falls into each voxel.
+
+    Parameters
+    ----------
+    pcd_np : np.ndarray
+        The lidar points, (n, 4).
+
+    voxel_size : float
+        The edge length of the voxel grid.
+
+    Returns
+    -------
+    pcd_np : np.ndarray
+        The downsampled lidar points, original order is kept.
+    """
+    if pcd_np.shape[0] == 0:
+        return pcd_np
+
+    voxel_coords = np.floor(pcd_np[:, :3] / voxel_size).astype(np.int64)
+    voxel_coords -= voxel_coords.min(axis=0)
+    voxel_ids = np.ravel_multi_index(voxel_coords.T,
+                                     voxel_coords.max(axis=0) + 1)
+    _, selected_index = np.unique(voxel_ids, return_index=True)
+    pcd_np = pcd_np[np.sort(selected_index)]
+
+    return pcd_np
+
+
 def downsample_lidar_minimum(pcd_np_list):
     """
     Given a list of pcd, find the minimum number and downsample all
@@ -210,6 +272,6 @@ def  read_pcd(pcd_path):
     pcd_np_points[:, 1] = np.transpose(pcd.pc_data["y"])
     pcd_np_points[:, 2] = np.transpose(pcd.pc_data["z"])
     pcd_np_points[:, 3] = np.transpose(pcd.pc_data["intensity"]) / 256.0
-    del_index = np.where(np.isnan(pcd_np_points))[0]
-    pcd_np_points = np.delete(pcd_np_points, del_index, axis=0)
+    # drop the rows containing nan with a single boolean mask
+    pcd_np_points = pcd_np_points[~np.isnan(pcd_np_points).any(axis=1)]
     return pcd_np_points, time
\ No newline at end of file
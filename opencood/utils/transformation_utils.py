@@ -21,6 +21,7 @@ Transformation utils
 from re import X
 import numpy as np
 import torch
+from numba import njit
 from icecream import ic
 from pyquaternion import Quaternion
 from opencood.utils.common_utils import check_numpy_to_torch
@@ -376,40 +377,49 @@ def get_relative_transformation(lidar_poses):
 
 
 
-def muilt_coord(rotationA2B, translationA2B, rotationB2C, translationB2C):
-    rotationA2B = np.array(rotationA2B).reshape(3, 3)
-    rotationB2C = np.array(rotationB2C).reshape(3, 3)
-    rotation = np.dot(rotationB2C, rotationA2B)
-    translationA2B = np.array(translationA2B).reshape(3, 1)
-    translationB2C = np.array(translationB2C).reshape(3, 1)
-    translation = np.dot(rotationB2C, translationA2B) + translationB2C
+@njit(cache=True)
+def _rot_and_trans_to_tfm(rotation, translation):
+    matrix = np.identity(4)
+    matrix[0:3, 0:3] = rotation
+    matrix[0:3, 3] = translation
+
+    return matrix
+
+@njit(cache=True)
+def _veh_side_tfm(rotation_l2n, translation_l2n, rotation_n2w, translation_n2w):
+    # compose the two extrinsics with one 4x4 product, T_world_lidar
+    return np.dot(_rot_and_trans_to_tfm(rotation_n2w, translation_n2w),
+                  _rot_and_trans_to_tfm(rotation_l2n, translation_l2n))
 
-    return rotation, translation
+@njit(cache=True)
+def _inf_side_tfm(rotation, translation, delta_x, delta_y):
+    matrix = _rot_and_trans_to_tfm(rotation, translation)
+    matrix[0, 3] += delta_x
+    matrix[1, 3] += delta_y
 
+    return matrix
+
+def _to_rotation(rotation):
+    return np.array(rotation, dtype=np.float64).reshape(3, 3)
+
+def _to_translation(translation):
+    return np.array(translation, dtype=np.float64).reshape(3)
 
 def veh_side_rot_and_trans_to_trasnformation_matrix(lidar_to_novatel_json_file,novatel_to_world_json_file):
-    matrix = np.empty([4,4])
-    rotationA2B = lidar_to_novatel_json_file["transform"]["rotation"]
-    translationA2B = lidar_to_novatel_json_file["transform"]["translation"]
-    rotationB2C = novatel_to_world_json_file["rotation"]
-    translationB2C = novatel_to_world_json_file["translation"]
-    rotation,translation = muilt_coord(rotationA2B, translationA2B, rotationB2C, translationB2C)
-    matrix[0:3, 0:3] = rotation
-    matrix[:, 3][0:3] = np.array(translation)[:, 0]
-    matrix[3, 0:3] = 0
-    matrix[3, 3] = 1
-    
+    # parse the json dicts to fixed shape arrays, the math runs in numba
+    matrix = _veh_side_tfm(
+        _to_rotation(lidar_to_novatel_json_file["transform"]["rotation"]),
+        _to_translation(lidar_to_novatel_json_file["transform"]["translation"]),
+        _to_rotation(novatel_to_world_json_file["rotation"]),
+        _to_translation(novatel_to_world_json_file["translation"]))
+
     return matrix
 
 def inf_side_rot_and_trans_to_trasnformation_matrix(json_file,system_error_offset):
-    matrix = np.empty([4,4])
-    matrix[0:3, 0:3] = json_file["rotation"]
-    translation = np.array(json_file["translation"])
-    translation[0][0] = translation[0][0] + system_error_offset["delta_x"]
-    translation[1][0] = translation[1][0] + system_error_offset["delta_y"]  #为啥有[1][0]??? --> translation是(3,1)的
-    matrix[:, 3][0:3] = translation[:, 0]
-    matrix[3, 0:3] = 0
-    matrix[3, 3] = 1
+    matrix = _inf_side_tfm(_to_rotation(json_file["rotation"]),
+                           _to_translation(json_file["translation"]),
+                           float(system_error_offset["delta_x"]),
+                           float(system_error_offset["delta_y"]))
 
     return matrix
 
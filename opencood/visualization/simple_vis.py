@@ -1,4 +1,5 @@
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import numpy as np
 
 import opencood.visualization.simple_plot3d.canvas_3d as canvas_3d
@@ -33,8 +34,36 @@ def visualize(pred_box_tensor, gt_tensor, pcd, pc_range, save_path, method='3d',
 
         """
 
-        pc_range = [int(i) for i in pc_range]
+        pcd_np, pred_box_np, pred_name, gt_box_np, gt_name = \
+            _to_numpy(pred_box_tensor, gt_tensor, pcd, vis_gt_box, vis_pred_box, uncertainty)
+        _draw_and_save(pcd_np, pred_box_np, pred_name, gt_box_np, gt_name,
+                       pc_range, save_path, method, left_hand)
+
+
+def visualize_both(pred_box_tensor, gt_tensor, pcd, pc_range, save_paths, methods=('3d', 'bev'), vis_gt_box=True, vis_pred_box=True, left_hand=False, uncertainty=None):
+        """
+        Same as visualize, but renders several methods of the same frame.
+        The point cloud and boxes are moved to numpy only once and shared
+        by all the canvases.
+
+        Parameters
+        ----------
+        save_paths : list
+            One save path for each method.
+
+        methods : tuple
+            The methods to render, 'bev' or '3d'.
+        """
+        pcd_np, pred_box_np, pred_name, gt_box_np, gt_name = \
+            _to_numpy(pred_box_tensor, gt_tensor, pcd, vis_gt_box, vis_pred_box, uncertainty)
+        for save_path, method in zip(save_paths, methods):
+            _draw_and_save(pcd_np, pred_box_np, pred_name, gt_box_np, gt_name,
+                           pc_range, save_path, method, left_hand)
+
+
+def _to_numpy(pred_box_tensor, gt_tensor, pcd, vis_gt_box, vis_pred_box, uncertainty):
         pcd_np = pcd.cpu().numpy()
+        pred_box_np, pred_name, gt_box_np, gt_name = None, None, None, None
 
         if vis_pred_box:
             pred_box_np = pred_box_tensor.cpu().numpy()
@@ -70,6 +99,14 @@ def visualize(pred_box_tensor, gt_tensor, pcd, pc_range, save_path, method='3d',
             gt_box_np = gt_tensor.cpu().numpy()
             gt_name = ['gt'] * gt_box_np.shape[0]
 
+        return pcd_np, pred_box_np, pred_name, gt_box_np, gt_name
+
+
+def _draw_and_save(pcd_np, pred_box_np, pred_name, gt_box_np, gt_name, pc_range, save_path, method, left_hand):
+        vis_gt_box = gt_box_np is not None
+        vis_pred_box = pred_box_np is not None
+        pc_range = [int(i) for i in pc_range]
+
         if method == 'bev':
             canvas = canvas_bev.Canvas_BEV_heading_right(canvas_shape=((pc_range[4]-pc_range[1])*10, (pc_range[3]-pc_range[0])*10),
                                             canvas_x_range=(pc_range[0], pc_range[3]), 
@@ -88,6 +125,12 @@ def visualize(pred_box_tensor, gt_tensor, pcd, pc_range, save_path, method='3d',
 
         elif method == '3d':
             canvas = canvas_3d.Canvas_3D(left_hand=left_hand)
+            if left_hand:
+                # Canvas_3D flips y of its inputs in place, keep the arrays
+                # shared with the other methods intact
+                pcd_np = pcd_np.copy()
+                gt_box_np = gt_box_np.copy() if vis_gt_box else None
+                pred_box_np = pred_box_np.copy() if vis_pred_box else None
             canvas_xy, valid_mask = canvas.get_canvas_coords(pcd_np)
             canvas.draw_canvas_points(canvas_xy[valid_mask])
             if vis_gt_box:
@@ -98,10 +141,14 @@ def visualize(pred_box_tensor, gt_tensor, pcd, pc_range, save_path, method='3d',
         else:
             raise(f"Not Completed for f{method} visualization.")
 
-        plt.axis("off")
+        # a figure of its own instead of the global pyplot one, so the
+        # rendering can run in a worker thread whatever the gui backend is
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.axis("off")
 
-        plt.imshow(canvas.canvas)
+        ax.imshow(canvas.canvas)
 
-        plt.tight_layout()
-        plt.savefig(save_path, transparent=False, dpi=400)
-        plt.clf()
+        fig.tight_layout()
+        fig.savefig(save_path, transparent=False, dpi=400)
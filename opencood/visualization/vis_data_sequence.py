@@ -43,24 +43,14 @@ if __name__ == '__main__':
         batch_data = train_utils.to_device(batch_data, device)
         gt_box_tensor = opencda_dataset.post_processor.generate_gt_bbx(batch_data)
 
-        vis_save_path = os.path.join(output_path, '3d_%05d.png' % i)
-        simple_vis.visualize(None,
+        vis_save_paths = [os.path.join(output_path, '3d_%05d.png' % i),
+                          os.path.join(output_path, 'bev_%05d.png' % i)]
+        simple_vis.visualize_both(None,
                             gt_box_tensor,
                             batch_data['ego']['origin_lidar'][0],
                             hypes['postprocess']['gt_range'],
-                            vis_save_path,
-                            method='3d',
-                            vis_gt_box = vis_gt_box,
-                            vis_pred_box = vis_pred_box,
-                            left_hand=False)
-            
-        vis_save_path = os.path.join(output_path, 'bev_%05d.png' % i)
-        simple_vis.visualize(None,
-                            gt_box_tensor,
-                            batch_data['ego']['origin_lidar'][0],
-                            hypes['postprocess']['gt_range'],
-                            vis_save_path,
-                            method='bev',
+                            vis_save_paths,
+                            methods=('3d', 'bev'),
                             vis_gt_box = vis_gt_box,
                             vis_pred_box = vis_pred_box,
                             left_hand=False)
\ No newline at end of file
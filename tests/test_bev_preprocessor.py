@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# License: TDG-Attribution-NonCommercial-NoDistrib
+
+"""
+Check that BevPreprocessor.preprocess_batch matches stacking the per frame
+preprocess outputs.
+"""
+
+import numpy as np
+
+from opencood.data_utils.pre_processor.bev_preprocessor import \
+    BevPreprocessor
+
+LIDAR_RANGE = [-12.8, -6.4, -3.0, 12.8, 6.4, 1.0]
+RES = 0.4
+
+
+def build_preprocessor():
+    L1, W1, H1, L2, W2, H2 = LIDAR_RANGE
+    input_shape = (int((L2 - L1) / RES), int((W2 - W1) / RES),
+                   int((H2 - H1) / RES) + 1)
+    params = {'cav_lidar_range': LIDAR_RANGE,
+              'geometry_param': {'L1': L1, 'L2': L2, 'W1': W1, 'W2': W2,
+                                 'H1': H1, 'H2': H2, 'res': RES,
+                                 'input_shape': input_shape}}
+    return BevPreprocessor(params, train=False)
+
+
+def random_points(rng, num):
+    low = np.array(LIDAR_RANGE[:3])
+    high = np.array(LIDAR_RANGE[3:])
+    xyz = rng.uniform(low, high, (num, 3))
+    intensity = rng.uniform(0, 1, (num, 1))
+    return np.hstack([xyz, intensity]).astype(np.float32)
+
+
+def boundary_points():
+    # corners of the range, both the lower (inside) and the upper (outside)
+    # edges, and points just outside of the lower edges
+    L1, W1, H1, L2, W2, H2 = LIDAR_RANGE
+    return np.array([[L1, W1, H1, 0.1],
+                     [L2, W2, H2, 0.2],
+                     [L2, 0., 0., 0.3],
+                     [0., W2, 0., 0.4],
+                     [0., 0., H2, 0.5],
+                     [L1 - 1., 0., 0., 0.6],
+                     [0., W1 - 1., 0., 0.7],
+                     [0., 0., H1 - 1., 0.8],
+                     [L2 + 1., W2 + 1., H2 + 1., 0.9]],
+                    dtype=np.float32)
+
+
+def assert_batch_matches(preprocessor, pcd_np_list):
+    batch_outputs = preprocessor.preprocess_batch(pcd_np_list)
+    assert len(batch_outputs) == len(pcd_np_list)
+    for pcd_np, batch_output in zip(pcd_np_list, batch_outputs):
+        np.testing.assert_allclose(
+            batch_output['bev_input'],
+            preprocessor.preprocess(pcd_np)['bev_input'],
+            rtol=1e-5, atol=1e-6)
+
+
+def test_random_frames():
+    rng = np.random.default_rng(0)
+    preprocessor = build_preprocessor()
+    assert_batch_matches(preprocessor,
+                         [random_points(rng, num) for num in (500, 1, 0, 64)])
+
+
+def test_boundary_points():
+    rng = np.random.default_rng(1)
+    preprocessor = build_preprocessor()
+    assert_batch_matches(preprocessor,
+                         [boundary_points(),
+                          np.vstack([random_points(rng, 100),
+                                     boundary_points()])])
+
+
+def test_points_outside_are_dropped():
+    preprocessor = build_preprocessor()
+    # all of them are more than one cell outside of the range
+    outside = boundary_points()[5:]
+    bev_input = preprocessor.preprocess_batch([outside])[0]['bev_input']
+    assert not bev_input.any()
+
+
+def test_empty_batch():
+    assert build_preprocessor().preprocess_batch([]) == []
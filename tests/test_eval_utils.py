@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# License: TDG-Attribution-NonCommercial-NoDistrib
+
+"""
+Check the numba bev iou of eval_utils against the shapely iou used by
+caluclate_tp_fp, and the vectorized calculate_ap.
+"""
+
+import numpy as np
+import pytest
+
+from opencood.utils import common_utils
+from opencood.utils.eval_utils import bev_iou_matrix, calculate_ap
+
+
+def box_corners(x, y, l, w, yaw):
+    """
+    Bev corners (4, 2) of a box centered at (x, y), counter clockwise.
+    """
+    corners = np.array([[l / 2, w / 2], [-l / 2, w / 2],
+                        [-l / 2, -w / 2], [l / 2, -w / 2]])
+    rot = np.array([[np.cos(yaw), -np.sin(yaw)],
+                    [np.sin(yaw), np.cos(yaw)]])
+    return corners @ rot.T + np.array([x, y])
+
+
+def random_boxes(rng, num):
+    boxes = [box_corners(*rng.uniform(-5, 5, 2),
+                         *rng.uniform(0.5, 5, 2),
+                         rng.uniform(-np.pi, np.pi))
+             for _ in range(num)]
+    return np.stack(boxes)
+
+
+def shapely_iou_matrix(det_corners, gt_corners):
+    det_polygons = common_utils.convert_format(det_corners)
+    gt_polygons = list(common_utils.convert_format(gt_corners))
+    return np.stack([
+        [d.intersection(g).area / d.union(g).area for g in gt_polygons]
+        for d in det_polygons])
+
+
+def test_random_boxes():
+    rng = np.random.default_rng(0)
+    det_corners = random_boxes(rng, 64)
+    gt_corners = random_boxes(rng, 48)
+
+    ious = bev_iou_matrix(det_corners, gt_corners)
+    assert ious.dtype == np.float64
+    np.testing.assert_allclose(
+        ious, shapely_iou_matrix(det_corners, gt_corners), atol=1e-9)
+
+
+def test_clockwise_boxes():
+    rng = np.random.default_rng(1)
+    det_corners = random_boxes(rng, 16)
+    gt_corners = random_boxes(rng, 16)[:, ::-1]
+
+    np.testing.assert_allclose(
+        bev_iou_matrix(det_corners, gt_corners),
+        shapely_iou_matrix(det_corners, gt_corners), atol=1e-9)
+
+
+@pytest.mark.parametrize('yaw', [0., 0.3, np.pi / 2, 2.5])
+def test_identical_boxes(yaw):
+    corners = box_corners(1., -2., 4.5, 1.8, yaw)[None]
+
+    np.testing.assert_allclose(bev_iou_matrix(corners, corners), [[1.]],
+                               atol=1e-9)
+
+
+@pytest.mark.parametrize('yaw', [0., 0.7])
+def test_touching_boxes(yaw):
+    # two boxes sharing one edge and two boxes sharing one corner
+    det_corners = np.stack([box_corners(0., 0., 2., 2., yaw),
+                            box_corners(0., 0., 2., 2., yaw)])
+    shift = np.array([np.cos(yaw), np.sin(yaw)]) * 2.
+    corner_shift = shift + np.array([-np.sin(yaw), np.cos(yaw)]) * 2.
+    gt_corners = np.stack([box_corners(*shift, 2., 2., yaw),
+                           box_corners(*corner_shift, 2., 2., yaw)])
+
+    ious = bev_iou_matrix(det_corners, gt_corners)
+    np.testing.assert_allclose(ious, np.zeros((2, 2)), atol=1e-9)
+    np.testing.assert_allclose(
+        ious, shapely_iou_matrix(det_corners, gt_corners), atol=1e-9)
+
+
+def test_empty_gt():
+    rng = np.random.default_rng(2)
+    ious = bev_iou_matrix(random_boxes(rng, 3), np.zeros((0, 4, 2)))
+    assert ious.shape == (3, 0)
+
+
+def test_calculate_ap():
+    # two gt boxes, the best scored prediction matches one of them
+    result_stat = {0.5: {'tp': [np.array([1, 0])], 'fp': [np.array([0, 1])],
+                         'gt': 2, 'score': [np.array([0.9, 0.4])]}}
+    ap, mrec, mprec = calculate_ap(result_stat, 0.5)
+    assert ap == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize('num_det', [0, 3])
+def test_calculate_ap_without_gt(num_det):
+    result_stat = {0.5: {'tp': [np.zeros(num_det, dtype=np.int64)],
+                         'fp': [np.ones(num_det, dtype=np.int64)],
+                         'gt': 0, 'score': [np.linspace(1, 0, num_det)]}}
+    with pytest.warns(UserWarning):
+        ap, mrec, mprec = calculate_ap(result_stat, 0.5)
+    assert ap == 0.
+    assert np.all(np.isfinite(mrec)) and np.all(np.isfinite(mprec))